@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# Copyright 2025 Yoann GUERIN
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Times the Conjunction plugin on synthetic multi-tagged libraries, without
+a display: the paned browser is replaced by the look-alikes of stubs.py.
+
+Tag values follow a Zipf distribution, like real libraries where a few
+genres hold most of the songs and a long tail of them hold a few songs.
+Each selection pattern is timed with OR and AND, against the plain set
+operations the paned browser does without the plugin, through the pane
+selection and through PaneModel.get_songs_conjunction; warm timings slower
+than those by more than SLOWDOWN are flagged, and make the script fail.
+
+    python3 benchmarks/conjunction_benchmark.py --sizes 10000 100000
+"""
+
+import argparse
+import itertools
+import random
+import sys
+import time
+
+import stubs
+
+TAGS = {
+    # tag: (number of values, Zipf exponent, values per song)
+    "genre": (300, 1.1, (1, 3)),
+    "grouping": (60, 1.3, (0, 2)),
+    "language": (25, 1.6, (1, 2)),
+}
+
+# name: ranks of the selected genres, 0 being "All"
+PATTERNS = [
+    ("head", [1]),
+    ("head + head", [1, 2]),
+    ("head + tail", [1, 150]),
+    ("3 mixed", [1, 5, 20]),
+    ("5 mixed", [2, 3, 8, 13, 40]),
+    ("All", [0]),
+    ("All + head", [0, 1]),
+]
+
+# Tolerated ratio of the warm timing to the plain sets one, for the noise,
+# and difference below which the fixed cost of a call hides the ratio
+SLOWDOWN = 1.5
+SLOWDOWN_FLOOR = 1e-4
+
+
+def zipf_sampler(rng, tag, count, exponent):
+    values = ["%s %d" % (tag, rank) for rank in range(1, count + 1)]
+    cum_weights = list(itertools.accumulate(
+        1.0 / rank ** exponent for rank in range(1, count + 1)))
+
+    def sample(k):
+        picked = set()
+        while len(picked) < k:
+            picked.update(rng.choices(values, cum_weights=cum_weights,
+                                      k=k - len(picked)))
+        return sorted(picked)
+    return sample
+
+
+def generate_library(size, seed):
+    rng = random.Random(seed)
+    samplers = {tag: (zipf_sampler(rng, tag, count, exponent), per_song)
+                for tag, (count, exponent, per_song) in TAGS.items()}
+    songs = []
+    for key in range(size):
+        tags = {tag: sample(rng.randint(*per_song))
+                for tag, (sample, per_song) in samplers.items()}
+        songs.append(stubs.Song("/music/%07d.flac" % key,
+                               sort_key=(rng.random(), key), **tags))
+    return stubs.Library(songs)
+
+
+def reference(model, paths, is_and):
+    """What the paned browser computes, with AND done on plain sets"""
+    keys = [model[path][0] for path in paths
+            if not isinstance(model[path][0], stubs.AllEntry)]
+    if not is_and or not keys:
+        return model.get_songs(paths)
+    songs = set(keys[0].songs)
+    for entry in keys[1:]:
+        songs &= entry.songs
+    return songs
+
+
+def best_of(repeat, func, before=None):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        # The previous result is freed outside of the timing
+        result = None
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def run(size, repeat, seed, plugin):
+    """Prints the timings of a library size, returns the slower patterns"""
+    quodlibet = stubs.sys.modules["quodlibet"]
+
+    start = time.perf_counter()
+    library = generate_library(size, seed)
+    print("\n%d songs (generated in %.1fs)"
+          % (size, time.perf_counter() - start))
+
+    last = stubs.Pane(stubs.PaneModel(stubs.PaneConfig("language")))
+    middle = stubs.Pane(stubs.PaneModel(stubs.PaneConfig("grouping")), last)
+    first = stubs.Pane(stubs.PaneModel(stubs.PaneConfig("genre")), middle)
+    quodlibet.app.library = library
+    quodlibet.app.browser = type("Browser", (), {
+        "_panes": [first, middle, last]})()
+
+    plugin.QUERY.clear()
+    plugin.INDEX.connect(library)
+    start = time.perf_counter()
+    first.fill(list(library.values()))
+    print("  first pane filled and indexed in %.3fs"
+          % (time.perf_counter() - start))
+
+    header = "  %-14s %-4s %9s %9s %9s %9s %9s %9s %8s" % (
+        "pattern", "mode", "songs", "sets", "cold", "warm", "sorted",
+        "get_songs", "speedup")
+    print(header)
+    print("  " + "-" * (len(header) - 2))
+
+    def consume():
+        # The next pane takes the handed over selection when it's refilled,
+        # without it freeing the previous one would be timed
+        plugin.INDEX.hand_over(None, 0)
+
+    slower = []
+    for name, ranks in PATTERNS:
+        first.paths = [0 if rank == 0 else
+                       first.model.path_of("genre %d" % rank)
+                       for rank in ranks]
+        for state in ("||", "&"):
+            plugin.plugin_config.set("state", state)
+            is_and = state == "&"
+
+            sets, expected = best_of(
+                repeat, lambda: reference(first.model, first.paths, is_and))
+            cold, songs = best_of(
+                repeat, lambda: plugin.conjunction_plugin_get_selected_songs(
+                    first), before=lambda: (consume(), plugin.QUERY.clear()))
+            warm, _ = best_of(
+                repeat, lambda: plugin.conjunction_plugin_get_selected_songs(
+                    first), before=consume)
+            ordered, _ = best_of(
+                repeat, lambda: plugin.conjunction_plugin_get_selected_songs(
+                    first, sort=True), before=consume)
+            model_songs, conjunction = best_of(
+                repeat, lambda: first.model.get_songs_conjunction(
+                    first.paths))
+
+            if set(songs) != expected:
+                raise AssertionError("%s %s: %d songs instead of %d" % (
+                    name, state, len(songs), len(expected)))
+            if conjunction != expected:
+                raise AssertionError(
+                    "%s %s: get_songs_conjunction gave %d songs instead of %d"
+                    % (name, state, len(conjunction), len(expected)))
+            flag = ""
+            if warm > sets * SLOWDOWN and warm - sets > SLOWDOWN_FLOOR:
+                flag = "  SLOWER"
+                slower.append("%d songs, %s %s" % (size, name, state))
+            print("  %-14s %-4s %9d %8.2fms %8.2fms %8.2fms %8.2fms %8.2fms"
+                  " %7.1fx%s"
+                  % (name, state, len(songs), sets * 1e3, cold * 1e3,
+                     warm * 1e3, ordered * 1e3, model_songs * 1e3,
+                     sets / max(warm, 1e-9), flag))
+
+    # What a selection change costs downstream, universes included
+    plugin.plugin_config.set("state", "&")
+    first.paths = [first.model.path_of("genre 1"),
+                   first.model.path_of("genre 2")]
+    refill, _ = best_of(repeat, first._Pane__selection_changed)
+    print("  next pane refilled from an AND selection in %.2fms"
+          % (refill * 1e3))
+    plugin.INDEX.disconnect()
+    return slower
+
+
+def patch(plugin):
+    """Monkey-patches the look-alikes like Conjunction.enabled does"""
+    stubs.Pane._Pane__get_selected_songs = \
+        plugin.conjunction_plugin_get_selected_songs
+    stubs.PaneModel.get_songs_conjunction = \
+        plugin.conjunction_plugin_get_songs
+    stubs.PaneModel.add_songs = plugin.filling_universe(
+        stubs.PaneModel.add_songs)
+    stubs.PaneModel.remove_songs = plugin.removing_universe(
+        stubs.PaneModel.remove_songs)
+    # No main loop here: always evaluate synchronously
+    plugin.WORKER.THRESHOLD = float("inf")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        "\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 1000000],
+                        help="library sizes, in songs")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs per timing, the best one is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stubs.install()
+    plugin = stubs.load_plugin("events/Conjunction.py")
+    patch(plugin)
+
+    slower = []
+    for size in args.sizes:
+        slower += run(size, args.repeat, args.seed, plugin)
+    if slower:
+        print("\nSlower than plain sets: " + "; ".join(slower))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
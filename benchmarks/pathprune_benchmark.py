@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# Copyright 2025 Yoann GUERIN
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Times RenamingPathPrune.filter_list on synthetic rename jobs, and checks
+its invariants on random ones, without a display: the quodlibet config
+and widgets are replaced by the look-alikes of stubs.py.
+
+Each branch of filter_list gets its own job: the // delimiter, positive,
+negative and zero numbers of folders, relative and absolute paths, values
+read from tags and values ranked by frequency.
+
+    python3 benchmarks/pathprune_benchmark.py --paths 100000 --checks 500
+"""
+
+import argparse
+import random
+import time
+
+import stubs
+
+GENRES = ["Rock", "Pop", "Jazz", "Folk", "Metal", "Blues", "Soul", "Funk",
+          "Electronic", "Ambient", "Classical", "Hip-Hop", "Reggae",
+          "Country", "Punk", "Indie", "Chanson", "Bossa Nova", "Swing"]
+GROUPINGS = ["Instrumental", "Live", "Acoustic", "Cover", "Soundtrack",
+             "Female Vocals", "Male Vocals", "Duet"]
+LANGUAGES = ["French", "English", "German", "Spanish", "Portuguese",
+             "Italian"]
+
+# name: (rename pattern, number of folders, extra settings)
+BRANCHES = [
+    ("//", "<genre>/<grouping>//<artist>/<album>/<title>", "2", {}),
+    ("positive", "<genre>/<language>/<artist>/<album>/<title>", "2", {}),
+    ("positive abs", "/music/<genre>/<artist>/<album>/<title>", "2", {}),
+    ("negative", "<genre>/<grouping>/<artist>/<album>/<title>", "-2", {}),
+    ("negative abs", "/music/<genre>/<artist>/<album>/<title>", "-2", {}),
+    ("zero", "<genre>/<artist>/<album>/<title>", "0", {}),
+    ("tags", "<genre>/<grouping>/<artist>/<album>/<title>", "2",
+     {"pathprune_tags": "genre, grouping"}),
+    ("frequency", "<genre>/<grouping>/<artist>/<album>/<title>", "2",
+     {"pathprune_frequency": "true"}),
+    ("no case", "<genre>/<grouping>/<artist>/<album>/<title>", "2",
+     {"pathprune_case_insensitive": "true"}),
+]
+
+DEFAULTS = {
+    "pathprune_priority_words": "jazz, re:bossa.*, chanson",
+    "pathprune_avoid_words": "pop, *vocals",
+    "pathprune_tags": "",
+    "pathprune_frequency": "false",
+    "pathprune_case_insensitive": "false",
+}
+
+
+def zipf_sample(rng, values, k, exponent=1.2):
+    weights = [1.0 / rank ** exponent for rank in range(1, len(values) + 1)]
+    picked = []
+    while len(picked) < k:
+        value = rng.choices(values, weights=weights)[0]
+        if value not in picked:
+            picked.append(value)
+    return picked
+
+
+def generate_songs(count, seed):
+    rng = random.Random(seed)
+    songs = []
+    for i in range(count):
+        artist = "Artist %d" % int(rng.paretovariate(1.0) * 10)
+        songs.append(stubs.Song(
+            "/old/%07d.flac" % i,
+            genre=zipf_sample(rng, GENRES, rng.randint(1, 3)),
+            grouping=zipf_sample(rng, GROUPINGS, rng.randint(0, 2)),
+            language=zipf_sample(rng, LANGUAGES, rng.randint(1, 2)),
+            artist=[artist],
+            album=["%s, Vol. %d" % (artist, rng.randint(1, 5))],
+            title=["Track %d" % i]))
+    return songs
+
+
+def render(pattern, song):
+    """What the rename dialog does with simple <tag> patterns"""
+    path = pattern
+    for tag in ("genre", "grouping", "language", "artist", "album", "title"):
+        path = path.replace("<%s>" % tag, song(tag, "Unknown"))
+    return path + ".flac"
+
+
+def configure(plugin, prune, max_folders, settings):
+    config = stubs.sys.modules["quodlibet"].config
+    config.update(DEFAULTS)
+    config.update(settings)
+    config["pathprune_maxfolders"] = max_folders
+    plugin.RenamingPathPrune._invalidate()
+    prune._max_folders = prune._parse_max_folders(max_folders)
+
+
+def benchmark(plugin, prune, count, repeat, seed):
+    start = time.perf_counter()
+    songs = generate_songs(count, seed)
+    library = stubs.Library(songs)
+    stubs.sys.modules["quodlibet"].app.library = library
+    print("%d songs (generated in %.1fs)"
+          % (count, time.perf_counter() - start))
+
+    header = "  %-13s %-7s %9s %9s %12s" % (
+        "branch", "folders", "cold", "warm", "paths/s")
+    print(header)
+    print("  " + "-" * (len(header) - 2))
+    for name, pattern, max_folders, settings in BRANCHES:
+        paths = [render(pattern, song) for song in songs]
+        configure(plugin, prune, max_folders, settings)
+
+        start = time.perf_counter()
+        prune.filter_list(songs, paths)
+        cold = time.perf_counter() - start
+
+        warm = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            prune.filter_list(songs, paths)
+            warm = min(warm, time.perf_counter() - start)
+        print("  %-13s %-7s %8.0fms %8.0fms %12.0f" % (
+            name, max_folders, cold * 1e3, warm * 1e3, count / warm))
+    stubs.sys.modules["quodlibet"].app.library = None
+
+
+def reference(path, max_folders, priority_words, avoid_words):
+    """The original algorithm, for plain words and paths that don't clash"""
+    def best_value(part):
+        values = [v.strip() for v in part.split(',')]
+        if len(values) <= 1:
+            return part
+        for word in priority_words:
+            for value in values:
+                if word == value.lower():
+                    return value
+        for value in values:
+            if value.lower() not in avoid_words:
+                return value
+        return values[0]
+
+    if "//" in path:
+        pre, post = path.split("//", 1)
+        return "/".join(best_value(p) for p in pre.split("/")) + "/" + post
+    if max_folders == 0:
+        return path
+    parts = path.split("/")
+    if max_folders > 0:
+        limit = max_folders + 1 if path.startswith("/") else max_folders
+    else:
+        limit = len(parts) - 1 + max_folders
+    return "/".join(best_value(part) if i < limit and i < len(parts) - 1
+                    else part for i, part in enumerate(parts))
+
+
+# Kinds of random jobs: paths split at commas, paths pruned to the same
+# ones, a job longer than a chunk, values read from the tags of the songs,
+# values ranked by frequency
+JOB_KINDS = ["commas", "clashes", "chunked", "tags", "frequency"]
+
+
+def random_settings(rng, kind):
+    words = [v.lower() for v in GENRES[:6]]
+    return {
+        "pathprune_priority_words": ", ".join(
+            rng.sample(words, rng.randint(0, 3))),
+        "pathprune_avoid_words": ", ".join(
+            rng.sample(words, rng.randint(0, 3))),
+        "pathprune_case_insensitive": rng.choice(["true", "false"]),
+        "pathprune_tags": "genre, grouping" if kind == "tags" else "",
+        "pathprune_frequency": "true" if kind == "frequency" else "false",
+    }
+
+
+def random_paths(rng, count, unique=False, names=None):
+    """Paths with components split at commas, ending with a unique filename
+    if `unique`, otherwise most of the time; filenames are drawn among
+    `names` ones instead, to make clashes"""
+    values = GENRES[:6] + ["rock", "Hip, Hop"]
+    paths = []
+    for i in range(count):
+        parts = [", ".join(rng.sample(values, rng.randint(1, 3)))
+                 for _ in range(rng.randint(1, 5))]
+        if len(parts) > 1 and rng.random() < 0.25:
+            parts[rng.randint(0, len(parts) - 2)] += "/"
+        path = "/".join(parts)
+        if rng.random() < 0.3:
+            path = "/" + path
+        if names:
+            path += "/%d.flac" % rng.randrange(names)
+        elif unique or rng.random() < 0.8:
+            path += "/%d.flac" % i
+        paths.append(path)
+    return paths
+
+
+def random_songs(rng, count):
+    """Songs with their paths, the way the rename dialog writes the
+    multi-valued tags: values without commas, joined by ", " """
+    values = GENRES[:6] + ["rock"]
+    songs = []
+    paths = []
+    for i in range(count):
+        song = stubs.Song(
+            "/old/%d.flac" % i,
+            genre=rng.sample(values, rng.randint(1, 3)),
+            grouping=rng.sample(GROUPINGS[:4], rng.randint(0, 2)))
+        parts = [song("genre")]
+        if rng.random() < 0.5:
+            parts.append(song("grouping", "Unknown"))
+        parts.append("%d.flac" % i)
+        path = "/".join(parts)
+        if rng.random() < 0.3:
+            path = "/" + path
+        songs.append(song)
+        paths.append(path)
+    return songs, paths
+
+
+def random_job(rng, plugin, kind):
+    """Returns the paths of a job, its songs (or None), its number of
+    folders and its settings"""
+    songs = None
+    if kind == "commas":
+        paths = random_paths(rng, rng.randint(1, 60))
+    elif kind == "clashes":
+        paths = random_paths(rng, rng.randint(2, 60), names=3)
+    elif kind == "chunked":
+        paths = random_paths(rng, plugin.RenamingPathPrune.CHUNK_SIZE
+                             + rng.randint(1, 500), unique=True)
+    else:
+        songs, paths = random_songs(rng, rng.randint(1, 60))
+    return paths, songs, str(rng.randint(-4, 4)), random_settings(rng, kind)
+
+
+def count_components(path):
+    """Components of a path once pruned: the first // becomes a /"""
+    return path.count("/") + 1 - ("//" in path)
+
+
+def pruned_positions(path, max_folders):
+    """Positions of the components of a path that get pruned"""
+    if "//" in path:
+        return range(path.split("//", 1)[0].count("/") + 1)
+    if max_folders == 0:
+        return range(0)
+    parts = path.split("/")
+    if max_folders > 0:
+        limit = max_folders + 1 if path.startswith("/") else max_folders
+    else:
+        limit = len(parts) - 1 + max_folders
+    return range(max(0, min(limit, len(parts) - 1)))
+
+
+def component_values(part, song, tags):
+    """The values a pruned component can take, None if it has one only"""
+    if song is not None and tags:
+        for tag in tags:
+            values = song.list(tag)
+            if len(values) > 1 and part == ", ".join(values):
+                return values
+        return None
+    values = [v.strip() for v in part.split(",")]
+    return values if len(values) > 1 else None
+
+
+def alternatives(path, new_path, max_folders, song, tags):
+    """The paths a clash can be avoided with: the pruned path with another
+    value for one of its pruned components"""
+    old_parts = (path.replace("//", "/", 1) if "//" in path
+                 else path).split("/")
+    new_parts = new_path.split("/")
+    for i in pruned_positions(path, max_folders):
+        for value in component_values(old_parts[i], song, tags) or ():
+            if value != new_parts[i]:
+                yield "/".join(new_parts[:i] + [value] + new_parts[i + 1:])
+
+
+def check_frequency(plugin, path, new_path, max_folders, settings):
+    """Without preferred values, the most common value is kept, avoided
+    ones last"""
+    priority = settings["pathprune_priority_words"].split(", ")
+    avoided = settings["pathprune_avoid_words"].split(", ")
+    count = plugin.HISTOGRAM.count
+    old_parts = path.split("/")
+    new_parts = new_path.split("/")
+    for i in pruned_positions(path, max_folders):
+        old, new = old_parts[i], new_parts[i]
+        values = [v.strip() for v in old.split(",")]
+        if len(values) == 1 or any(v.lower() in priority for v in values):
+            continue
+        candidates = [v for v in values if v.lower() not in avoided] or values
+        assert count(new) == max(count(v) for v in candidates), (
+            path, new_path, {v: count(v) for v in values})
+
+
+def check(plugin, prune, cases, seed):
+    rng = random.Random(seed)
+    quodlibet = stubs.sys.modules["quodlibet"]
+    for case in range(cases):
+        kind = JOB_KINDS[case % len(JOB_KINDS)]
+        paths, songs, max_folders, settings = random_job(rng, plugin, kind)
+        quodlibet.app.library = stubs.Library(songs or [])
+        configure(plugin, prune, max_folders, settings)
+        new_paths = prune.filter_list(songs, paths)
+        context = (case, kind, max_folders, settings)
+
+        assert len(new_paths) == len(paths), context
+        unique = len(set(paths)) == len(paths)
+        is_folded = settings["pathprune_case_insensitive"] == "true"
+        folded = [path.casefold() if is_folded else path
+                  for path in new_paths]
+        expected = [reference(
+            path, int(max_folders),
+            settings["pathprune_priority_words"].split(", "),
+            settings["pathprune_avoid_words"].split(", "))
+            for path in paths]
+        clashes = len(set(folded)) < len(folded)
+
+        for index, (path, new_path) in enumerate(zip(paths, new_paths)):
+            # The number of components never changes
+            assert count_components(path) == new_path.count("/") + 1, (
+                context, path, new_path)
+            # Pruned components are one of their values, the last one is
+            # never touched
+            old_parts = (path.replace("//", "/", 1) if "//" in path
+                         else path).split("/")
+            new_parts = new_path.split("/")
+            assert old_parts[-1] == new_parts[-1], (context, path, new_path)
+            for old, new in zip(old_parts, new_parts):
+                assert new == old or new in [
+                    v.strip() for v in old.split(",")], (context, old, new)
+            # Pruning again changes nothing
+            if "//" not in path and not clashes:
+                song = None if songs is None else [songs[index]]
+                assert prune.filter_list(song, [new_path]) == [new_path], (
+                    context, new_path)
+            if kind == "frequency" and not clashes:
+                check_frequency(
+                    plugin, path, new_path, int(max_folders), settings)
+
+        # Same as the original algorithm, unless that one made a clash
+        folded_expected = [path.casefold() if is_folded else path
+                           for path in expected]
+        if (kind != "frequency" and unique
+                and len(set(folded_expected)) == len(expected)):
+            assert new_paths == expected, (context, paths)
+        # Clashes are only left when all the values to try were taken
+        if clashes:
+            tags = [t for t in settings["pathprune_tags"].split(", ") if t]
+            taken = set(folded)
+            seen = set()
+            for index, key in enumerate(folded):
+                if key in seen:
+                    song = None if songs is None else songs[index]
+                    for path in alternatives(paths[index], new_paths[index],
+                                             int(max_folders), song, tags):
+                        path = path.casefold() if is_folded else path
+                        assert path in taken, (
+                            context, paths[index], new_paths[index], path)
+                seen.add(key)
+    quodlibet.app.library = None
+    print("%d random jobs checked (%s)" % (cases, ", ".join(JOB_KINDS)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        "\n")[0])
+    parser.add_argument("--paths", type=int, default=100000,
+                        help="paths per rename job, 0 to only check")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="warm runs per timing, the best one is kept")
+    parser.add_argument("--checks", type=int, default=500,
+                        help="random rename jobs to check, 0 to only time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stubs.install()
+    plugin = stubs.load_plugin("editing/RenamingPathPrune.py")
+    prune = plugin.RenamingPathPrune()
+
+    if args.checks:
+        check(plugin, prune, args.checks, args.seed)
+    if args.paths:
+        benchmark(plugin, prune, args.paths, args.repeat, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+# Copyright 2025 Yoann GUERIN
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Minimal stand-ins for the gi and quodlibet modules used by the plugins,
+so that their logic can be loaded and timed without a display.
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Anything:
+    """Accepts any attribute access or call, for the GTK parts. It is false,
+    so that loops like `while Gtk.events_pending()` end."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return Anything()
+
+    def __call__(self, *args, **kwargs):
+        return Anything()
+
+    def __or__(self, other):
+        return self
+
+    def __bool__(self):
+        return False
+
+    def __mro_entries__(self, bases):
+        # Subclassing a widget gives a class accepting any method call
+        return (Widget,)
+
+
+class Widget:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return Anything()
+
+
+class Config(dict):
+    """PluginConfig and quodlibet.config look-alike"""
+
+    def get(self, *args):
+        # PluginConfig.get(key) or config.get(section, key, default)
+        if len(args) == 3:
+            return dict.get(self, args[1], args[2])
+        return dict.get(self, args[0], "")
+
+    def set(self, *args):
+        dict.__setitem__(self, args[-2], args[-1])
+
+    def getboolean(self, section, key, default=False):
+        return str(dict.get(self, key, default)).lower() == "true"
+
+    @property
+    def defaults(self):
+        return self
+
+
+class Signals:
+    def __init__(self):
+        self._handlers = {}
+        self._next_id = 0
+
+    def connect(self, signal, callback, *args):
+        self._next_id += 1
+        self._handlers[self._next_id] = (signal, callback, args)
+        return self._next_id
+
+    def disconnect(self, handler_id):
+        self._handlers.pop(handler_id, None)
+
+    def emit(self, signal, *args):
+        for name, callback, extra in list(self._handlers.values()):
+            if name == signal:
+                callback(self, *args, *extra)
+
+
+class Library(Signals, dict):
+    """Song library emitting added/changed/removed"""
+
+    __hash__ = object.__hash__
+
+    def __init__(self, songs=()):
+        Signals.__init__(self)
+        dict.__init__(self, ((song.key, song) for song in songs))
+
+    def add(self, songs):
+        for song in songs:
+            self[song.key] = song
+        self.emit("added", songs)
+
+    def remove(self, songs):
+        for song in songs:
+            del self[song.key]
+        self.emit("removed", songs)
+
+    def changed(self, songs):
+        self.emit("changed", songs)
+
+
+class Song(dict):
+    """AudioFile look-alike: tags are lists of values"""
+
+    __hash__ = object.__hash__
+    __eq__ = object.__eq__
+
+    def __init__(self, key, sort_key=None, **tags):
+        super().__init__(tags)
+        self.key = key
+        self.sort_key = (key,) if sort_key is None else sort_key
+
+    def list(self, tag):
+        return list(self.get(tag, []))
+
+    def __call__(self, tag, default=""):
+        return ", ".join(self.get(tag, [])) or default
+
+
+class BaseEntry:
+    def __init__(self, key=None, songs=()):
+        self.key = key
+        self.songs = set(songs)
+
+
+class AllEntry(BaseEntry):
+    def __init__(self):
+        super().__init__(None)
+
+
+class SongsEntry(BaseEntry):
+    pass
+
+
+class UnknownEntry(SongsEntry):
+    def __init__(self, songs=()):
+        super().__init__("", songs)
+
+
+class PaneConfig:
+    """One tag per pane"""
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    def format(self, song):
+        return [(value, value) for value in song.get(self.tag, [])]
+
+
+class PaneModel:
+    """PaneModel look-alike: an AllEntry row followed by one row per key"""
+
+    def __init__(self, config):
+        self.config = config
+        self._rows = []
+        self._by_key = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, path):
+        return [self._rows[path]]
+
+    def clear(self):
+        self._rows = []
+        self._by_key = {}
+
+    def itervalues(self):
+        return iter(self._rows)
+
+    def add_songs(self, songs):
+        if not self._rows:
+            self._rows.append(AllEntry())
+        for song in songs:
+            for key, _sort in self.config.format(song) or [("", "")]:
+                entry = self._by_key.get(key)
+                if entry is None:
+                    entry = UnknownEntry() if key == "" else SongsEntry(key)
+                    self._by_key[key] = entry
+                    self._rows.append(entry)
+                entry.songs.add(song)
+
+    def remove_songs(self, songs, remove_if_empty=True):
+        for entry in self._rows:
+            entry.songs.difference_update(songs)
+
+    def get_songs(self, paths):
+        songs = set()
+        for path in paths:
+            entry = self._rows[path]
+            if isinstance(entry, AllEntry):
+                for entry in self._rows:
+                    songs.update(entry.songs)
+                return songs
+            songs.update(entry.songs)
+        return songs
+
+    def path_of(self, key):
+        return self._rows.index(self._by_key[key])
+
+
+class Column(Anything):
+    def __init__(self, title):
+        self._title = title
+        self._cells = []
+
+    def get_title(self):
+        return self._title
+
+    def pack_end(self, cell, expand):
+        self._cells.append(cell)
+
+    def get_cells(self):
+        return list(self._cells)
+
+
+class Selection:
+    def __init__(self, pane):
+        self._pane = pane
+
+    def get_selected_rows(self):
+        return self._pane.model, list(self._pane.paths)
+
+    def count_selected_rows(self):
+        return len(self._pane.paths)
+
+
+class Pane(Signals):
+    """Pane look-alike, filling the next pane on selection changes"""
+
+    def __init__(self, model, next_pane=None):
+        super().__init__()
+        self.model = model
+        self.paths = [0]
+        self.next_pane = next_pane
+
+    def get_model(self):
+        return self.model
+
+    def get_selection(self):
+        return Selection(self)
+
+    def get_columns(self):
+        return [Column(self.model.config.tag.title())]
+
+    def get_window(self):
+        return None
+
+    def queue_draw(self):
+        pass
+
+    def fill(self, songs):
+        self.model.clear()
+        self.model.add_songs(songs)
+        self.paths = [0]
+
+    def _Pane__get_selected_songs(self, sort=False):
+        return sorted(self.model.get_songs(self.get_selection()
+                                           .get_selected_rows()[1]),
+                      key=lambda song: song.sort_key) \
+            if sort else self.model.get_songs(self.paths)
+
+    def _Pane__selection_changed(self, *args):
+        if self.next_pane is not None:
+            self.next_pane.fill(self._Pane__get_selected_songs())
+
+
+def module(name, **attrs):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attrs)
+    mod.__getattr__ = lambda attr: Anything()
+    sys.modules[name] = mod
+    return mod
+
+
+def install(user_dir=None):
+    """Registers the stub modules, returns the quodlibet one"""
+    user_dir = user_dir or tempfile.mkdtemp(prefix="quodlibet-")
+    module("gi")
+    repository = module("gi.repository")
+    for name in ("Gtk", "Gdk", "GdkPixbuf", "Gio", "GLib", "GObject",
+                 "Pango", "Gst"):
+        setattr(repository, name, Anything())
+
+    def print_d(*args, **kwargs):
+        pass
+
+    quodlibet = module(
+        "quodlibet", _=lambda text: text, app=types.SimpleNamespace(),
+        config=Config(), print_d=print_d, print_w=print_d,
+        get_user_dir=lambda: user_dir)
+    module("quodlibet.plugins", PluginConfig=lambda name: Config())
+    module("quodlibet.plugins.events", EventPlugin=object)
+    module("quodlibet.plugins.editing",
+           RenameFilesPlugin=type("RenameFilesPlugin", (), {}))
+    module("quodlibet.browsers")
+    module("quodlibet.browsers.paned")
+    module("quodlibet.browsers.paned.pane", Pane=Pane)
+    module("quodlibet.browsers.paned.models", PaneModel=PaneModel,
+           AllEntry=AllEntry, UnknownEntry=UnknownEntry)
+    module("quodlibet.qltk", Icons=Anything(), print_d=print_d,
+           get_top_parent=lambda widget: None)
+    module("quodlibet.qltk.getstring", GetStringDialog=Anything)
+    module("quodlibet.util", print_d=print_d)
+    module("senf", fsn2text=str, text2fsn=str)
+    return quodlibet
+
+
+def load_plugin(relative_path):
+    """Loads a plugin file of the repository as a module"""
+    path = os.path.join(ROOT, relative_path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
@@ -3,14 +3,219 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
-from gi.repository import Gtk, GObject
+import fnmatch
+import re
+from collections import Counter
 
-from quodlibet import _, config
+from gi.repository import Gtk, GObject, GLib
+
+from quodlibet import _, app, config
 from quodlibet.plugins.editing import RenameFilesPlugin
 from quodlibet.util import print_d
 from quodlibet.qltk import Icons
 
 
+def compile_word(word):
+    """Returns a matching function for a rule, or None for a plain word.
+
+    Words starting with "re:" are regular expressions, words containing
+    *, ? or [ are glob patterns. Both match whole values, ignoring case.
+    """
+    if word.startswith("re:"):
+        try:
+            return re.compile(word[3:], re.IGNORECASE).fullmatch
+        except re.error as e:
+            print_d(f"PathPrune: Invalid regular expression '{word}': {e}")
+            return None
+    if any(c in word for c in "*?["):
+        return re.compile(fnmatch.translate(word), re.IGNORECASE).match
+    return None
+
+
+def tag_components(song, tags):
+    """Maps the way multi-valued tags of a song are written in a path
+    ("Rock, Pop") to their actual values"""
+    components = {}
+    for tag in tags:
+        values = song.list(tag)
+        if len(values) > 1:
+            components[", ".join(values)] = values
+    return components
+
+
+class TagHistogram:
+    """Number of songs of the library carrying each value of some tags
+    (ignoring case), counted once then kept up to date from the library
+    signals"""
+
+    def __init__(self):
+        self._library = None
+        self._sig_ids = []
+        self._tags = ()
+        self._counts = Counter()
+        self._song_values = {}
+        # Changes each time the counts change
+        self.version = 0
+
+    def watch(self, library, tags):
+        tags = tuple(tags)
+        if library is self._library and tags == self._tags:
+            return
+        self.unwatch()
+        self._library = library
+        self._tags = tags
+        self._sig_ids = [
+            library.connect("added", self._on_added),
+            library.connect("changed", self._on_changed),
+            library.connect("removed", self._on_removed),
+        ]
+        self._add(library.values())
+
+    def unwatch(self):
+        if self._library is not None:
+            for sig_id in self._sig_ids:
+                self._library.disconnect(sig_id)
+        self._library = None
+        self._sig_ids = []
+        self._counts.clear()
+        self._song_values.clear()
+        self.version += 1
+
+    def count(self, value):
+        return self._counts.get(value.lower(), 0)
+
+    def _values(self, song):
+        return tuple({v.lower() for tag in self._tags for v in song.list(tag)})
+
+    def _add(self, songs):
+        for song in songs:
+            values = self._song_values[song] = self._values(song)
+            self._counts.update(values)
+        self.version += 1
+
+    def _remove(self, songs):
+        for song in songs:
+            self._counts.subtract(self._song_values.pop(song, ()))
+        self.version += 1
+
+    def _on_added(self, library, songs):
+        self._add(songs)
+
+    def _on_changed(self, library, songs):
+        # Most changes (play counts, ratings) don't touch the counted tags
+        changed = [song for song in songs
+                   if self._values(song) != self._song_values.get(song)]
+        if changed:
+            self._remove(changed)
+            self._add(changed)
+
+    def _on_removed(self, library, songs):
+        self._remove(songs)
+
+
+HISTOGRAM = TagHistogram()
+
+
+class PruneRules:
+    """Preferred and avoided values, compiled once: plain words are looked
+    up in dictionaries, and the ranking of the values of each distinct path
+    component is memoized since the same ones come up for many songs."""
+
+    def __init__(self, priority_words, avoid_words, histogram=None):
+        self._ranks = {}
+        self._rank_patterns = []
+        for rank, word in enumerate(priority_words):
+            match = compile_word(word)
+            if match is not None:
+                self._rank_patterns.append((rank, match))
+            else:
+                self._ranks.setdefault(word.lower(), rank)
+
+        self._avoided = set()
+        self._avoid_patterns = []
+        for word in avoid_words:
+            match = compile_word(word)
+            if match is not None:
+                self._avoid_patterns.append(match)
+            else:
+                self._avoided.add(word.lower())
+
+        # Values neither preferred nor avoided are ranked by frequency
+        self._histogram = histogram
+        self._version = None
+        self._memo = {}
+
+    # Above this many memoized components, the memo starts over
+    MAX_MEMO = 100000
+
+    def rank(self, value):
+        """Returns the rank of a preferred value, None for other values"""
+        rank = self._ranks.get(value.lower())
+        for pattern_rank, match in self._rank_patterns:
+            if rank is not None and pattern_rank >= rank:
+                break
+            if match(value):
+                rank = pattern_rank
+                break
+        return rank
+
+    def is_avoided(self, value):
+        return (value.lower() in self._avoided
+                or any(match(value) for match in self._avoid_patterns))
+
+    def refresh(self):
+        """Forgets the rankings if the frequencies changed since"""
+        if (self._histogram is not None
+                and self._histogram.version != self._version):
+            self._version = self._histogram.version
+            self._memo.clear()
+
+    def best_value(self, part):
+        choices = self.choices(part)
+        return part if choices is None else choices[0]
+
+    def choices(self, part):
+        """Returns the values of a path component, best first, or None if
+        there's nothing to choose from"""
+        try:
+            return self._memo[part]
+        except KeyError:
+            pass
+        values = [v.strip() for v in part.split(',')]
+        choices = self.choices_of(values) if len(values) > 1 else None
+        self._remember(part, choices)
+        return choices
+
+    def choices_of(self, values):
+        """Same as choices, for values known to come from a tag"""
+        key = tuple(values)
+        choices = self._memo.get(key)
+        if choices is None:
+            choices = self._rank_values(values)
+            self._remember(key, choices)
+        return choices
+
+    def _remember(self, key, choices):
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo.clear()
+        self._memo[key] = choices
+
+    def _rank_values(self, values):
+        """Preferred values by rank, then the others, avoided ones last"""
+        histogram = self._histogram
+
+        def sort_key(item):
+            position, value = item
+            rank = self.rank(value)
+            if rank is not None:
+                return (0, rank, position)
+            frequency = histogram.count(value) if histogram else 0
+            return (2 if self.is_avoided(value) else 1, -frequency, position)
+
+        return tuple(value for _position, value
+                     in sorted(enumerate(values), key=sort_key))
+
+
 class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
     PLUGIN_ID = "RenamingPathPrune"
     PLUGIN_NAME = _("Renaming Path Prune")
@@ -24,6 +229,24 @@ class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
     __gsignals__ = {"changed": (GObject.SignalFlags.RUN_LAST, None, ())}
     active = True
 
+    # Paths pruned between two updates of the progress bar
+    CHUNK_SIZE = 2000
+
+    # Compiled rules and settings, shared by all instances until the
+    # preferences change
+    _rules = None
+    _tags = None
+    _case_insensitive = None
+
+    # Tags counted by the frequency strategy when none are given
+    HISTOGRAM_TAGS = ["genre", "grouping"]
+
+    @classmethod
+    def _invalidate(cls):
+        cls._rules = None
+        cls._tags = None
+        cls._case_insensitive = None
+
     @classmethod
     def PluginPreferences(cls, window):
         grid = Gtk.Grid()
@@ -34,11 +257,15 @@ class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
         def connect_config_entry(entry, key):
             def on_changed(e):
                 config.set("plugins", key, e.get_text())
+                cls._invalidate()
             entry.connect("changed", on_changed)
 
         # Preferred values
         label_priority = Gtk.Label(
             label=_("Preferred values (comma-separated):"))
+        label_priority.set_tooltip_text(_(
+            "Values may be glob patterns (e.g. 'french*') or regular "
+            "expressions prefixed with 're:'"))
         label_priority.set_halign(Gtk.Align.START)
         grid.attach(label_priority, 0, 0, 1, 1)
 
@@ -53,6 +280,7 @@ class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
         # Avoided values
         label_avoid = Gtk.Label(
             label=_("Avoided values (comma-separated):"))
+        label_avoid.set_tooltip_text(label_priority.get_tooltip_text())
         label_avoid.set_halign(Gtk.Align.START)
         grid.attach(label_avoid, 0, 1, 1, 1)
 
@@ -63,12 +291,58 @@ class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
         grid.attach(avoid_entry, 1, 1, 1, 1)
         connect_config_entry(avoid_entry, "pathprune_avoid_words")
 
+        # Tags
+        label_tags = Gtk.Label(
+            label=_("Read values from tags (comma-separated):"))
+        label_tags.set_tooltip_text(_(
+            "E.g. 'genre, grouping'. Path components written from these "
+            "tags are matched with the values of the song, instead of being "
+            "split at commas. Other components are left as they are."))
+        label_tags.set_halign(Gtk.Align.START)
+        grid.attach(label_tags, 0, 2, 1, 1)
+
+        tags_entry = Gtk.Entry()
+        tags_entry.set_hexpand(True)
+        tags_entry.set_text(config.get("plugins", "pathprune_tags", ""))
+        grid.attach(tags_entry, 1, 2, 1, 1)
+        connect_config_entry(tags_entry, "pathprune_tags")
+
+        # Frequency strategy
+        frequency_check = Gtk.CheckButton(
+            label=_("Otherwise prefer the values most common in the library"))
+        frequency_check.set_tooltip_text(_(
+            "Gives fewer, fuller folders. Values are counted in the tags "
+            "to read values from, or in genre and grouping if none."))
+        frequency_check.set_active(config.getboolean(
+            "plugins", "pathprune_frequency", False))
+
+        def on_frequency_toggled(button):
+            config.set("plugins", "pathprune_frequency",
+                       "true" if button.get_active() else "false")
+            cls._invalidate()
+        frequency_check.connect("toggled", on_frequency_toggled)
+        grid.attach(frequency_check, 0, 3, 2, 1)
+
+        # Clashes
+        case_check = Gtk.CheckButton(
+            label=_("Paths differing only by case clash (FAT, SMB targets)"))
+        case_check.set_active(config.getboolean(
+            "plugins", "pathprune_case_insensitive", False))
+
+        def on_case_toggled(button):
+            config.set("plugins", "pathprune_case_insensitive",
+                       "true" if button.get_active() else "false")
+            cls._invalidate()
+        case_check.connect("toggled", on_case_toggled)
+        grid.attach(case_check, 0, 4, 2, 1)
+
         explanation_markup = _(
             "<b>Note on Operation:</b> The plugin processes path components "
             "(folders) by splitting them at the comma (','). "
             "This is effective for multi-valued tags like &lt;genre&gt; or "
             "&lt;grouping&gt;, but <b>should be avoided</b> for tags that may "
-            "legitimately contain commas (e.g., certain album titles).\n\n"
+            "legitimately contain commas (e.g., certain album titles), "
+            "unless the tags to read values from are given above.\n\n"
             "To limit the plugin's impact, you can specify in the renaming panel "
             "the number of path components (folders) to process:\n"
             "if the number is positive, the first <i>[N]</i> folders are processed,\n"
@@ -76,7 +350,9 @@ class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
             "If the number is zero or left empty, the plugin only acts on folders "
             "that appear before a double delimiter (//) in your rename pattern.\n"
             "E.g.: <b>&lt;genre&gt;/&lt;grouping&gt;//&lt;artist&gt;/&lt;year&gt; "
-            "- &lt;album&gt;</b>"
+            "- &lt;album&gt;</b>\n\n"
+            "When pruning makes several songs end up at the same path, the "
+            "next preferred values are used for the later ones."
         )
         explanation_label = Gtk.Label(
             label=explanation_markup,
@@ -86,7 +362,7 @@ class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
             justify=Gtk.Justification.LEFT
         )
         explanation_label.set_halign(Gtk.Align.START)
-        grid.attach(explanation_label, 0, 2, 2, 1)
+        grid.attach(explanation_label, 0, 5, 2, 1)
 
         return grid
 
@@ -106,82 +382,262 @@ class RenamingPathPrune(Gtk.Box, RenameFilesPlugin):
             Gtk.Label(label=_(" path components, automatically select a single value from multi-valued tags.")),
             False, False, 0)
 
+        self._progress = Gtk.ProgressBar(show_text=True)
+        self._progress.set_no_show_all(True)
+        self.pack_start(self._progress, True, True, 0)
+        self._cancel_button = Gtk.Button(label=_("Cancel"))
+        self._cancel_button.set_no_show_all(True)
+        self._cancel_button.connect("clicked", self._cancel)
+        self.pack_start(self._cancel_button, False, False, 0)
+        self._clashes_label = Gtk.Label()
+        self._clashes_label.set_no_show_all(True)
+        self.pack_start(self._clashes_label, False, False, 0)
+
+        self._max_folders = self._parse_max_folders(max_folders_str)
+        self._cancelled = False
+        self._filtering = False
+        self._destroyed = False
         self._maxfolders_entry.connect("changed", self._on_maxfolders_changed)
+        self.connect("destroy", self._on_destroy)
+
+    def _parse_max_folders(self, max_folders_str):
+        try:
+            return int(max_folders_str)
+        except ValueError:
+            print_d(f"PathPrune: Invalid number '{max_folders_str}', doing nothing.")
+            return None
 
     def _on_maxfolders_changed(self, entry):
         config.set("plugins", "pathprune_maxfolders", entry.get_text())
-        self.emit("changed")
+        self._max_folders = self._parse_max_folders(entry.get_text())
+        if self._filtering:
+            # Handled from the events pumped while pruning: stop, the
+            # preview gets outdated once it returns
+            self._cancel()
+        else:
+            self.emit("changed")
+
+    def _cancel(self, *args):
+        self._cancelled = True
+
+    def _on_destroy(self, *args):
+        self._cancelled = True
+        self._destroyed = True
+        # Don't follow the library for the rest of the session, the rules
+        # watch it again if another rename dialog needs the frequencies
+        HISTOGRAM.unwatch()
+        type(self)._rules = None
+
+    def _outdate_preview(self):
+        if not self._destroyed:
+            self.emit("changed")
+        return False
 
     def _get_words_from_config(self, key):
         words_str = config.get("plugins", key, "")
-        return [w.strip().lower() for w in words_str.split(',') if w.strip()]
-
-    def _get_best_value(self, part, priority_words, avoid_words):
-        values = [v.strip() for v in part.split(',')]
-        if len(values) <= 1:
-            return part
-
-        for p_word in priority_words:
-            for value in values:
-                if p_word == value.lower():
-                    return value
-
-        found_value = None
-        for value in values:
-            if value.lower() not in avoid_words:
-                found_value = value
-                break
-
-        return found_value if found_value is not None else values[0]
+        # Not lowercased here, regular expressions are case sensitive
+        return [w.strip() for w in words_str.split(',') if w.strip()]
+
+    def _get_rules(self):
+        cls = type(self)
+        if cls._rules is None:
+            histogram = None
+            if config.getboolean("plugins", "pathprune_frequency", False):
+                histogram = HISTOGRAM
+                histogram.watch(
+                    app.library, self._get_tags() or self.HISTOGRAM_TAGS)
+            else:
+                HISTOGRAM.unwatch()
+            cls._rules = PruneRules(
+                self._get_words_from_config("pathprune_priority_words"),
+                self._get_words_from_config("pathprune_avoid_words"),
+                histogram)
+        cls._rules.refresh()
+        return cls._rules
+
+    def _get_tags(self):
+        cls = type(self)
+        if cls._tags is None:
+            cls._tags = [
+                t.lower() for t in self._get_words_from_config("pathprune_tags")]
+        return cls._tags
+
+    def _is_case_insensitive(self):
+        cls = type(self)
+        if cls._case_insensitive is None:
+            cls._case_insensitive = config.getboolean(
+                "plugins", "pathprune_case_insensitive", False)
+        return cls._case_insensitive
+
+    def _as_song(self, item):
+        """The rename dialog may give the songs or their filenames"""
+        if hasattr(item, "list"):
+            return item
+        return app.library.get(item)
+
+    def _split(self, path, max_folders):
+        """Returns the components of a path, and the positions of the ones
+        to prune"""
+        if "//" in path:
+            pre, post = path.split('//', 1)
+            pre_parts = pre.split('/')
+            return pre_parts + [post], range(len(pre_parts))
+
+        parts = path.split("/")
+        if max_folders == 0:
+            return parts, range(0)
+
+        is_absolute = path.startswith('/')
+        limit = 0
+        if max_folders > 0:
+            limit = max_folders + 1 if is_absolute else max_folders
+        else:
+            limit = len(parts) - 1 + max_folders
+        return parts, range(max(0, min(limit, len(parts) - 1)))
+
+    def _prune(self, path, max_folders, choose):
+        parts, positions = self._split(path, max_folders)
+        for i in positions:
+            choices = choose(parts[i])
+            if choices is not None:
+                parts[i] = choices[0]
+        return "/".join(parts)
+
+    def _alternatives(self, path, max_folders, choose):
+        """Yields the path pruned with the next preferred values, changing
+        one component at a time, first components first"""
+        parts, positions = self._split(path, max_folders)
+        all_choices = {i: choose(parts[i]) for i in positions}
+        for i, choices in all_choices.items():
+            if choices is not None:
+                parts[i] = choices[0]
+        for i, choices in all_choices.items():
+            if choices is None:
+                continue
+            best = parts[i]
+            for value in choices[1:]:
+                parts[i] = value
+                yield "/".join(parts)
+            parts[i] = best
 
     def filter_list(self, songs, paths):
-        max_folders_str = self._maxfolders_entry.get_text()
-
-        try:
-            max_folders = int(max_folders_str)
-        except ValueError:
-            print_d(f"PathPrune: Invalid number '{max_folders_str}', doing nothing.")
+        max_folders = self._max_folders
+        if max_folders is None:
+            return paths
+        if self._filtering:
+            # Started from the events pumped while pruning, stop both
+            self._cancel()
             return paths
 
-        priority_words = self._get_words_from_config("pathprune_priority_words")
-        avoid_words = self._get_words_from_config("pathprune_avoid_words")
-
-        new_paths = []
-        for path in paths:
-            if "//" in path:
-                pre, post = path.split('//', 1)
-                pre_parts = pre.split('/')
-                new_pre_parts = []
-                for part in pre_parts:
-                    new_pre_parts.append(self._get_best_value(
-                        part, priority_words, avoid_words))
-                processed_pre = "/".join(new_pre_parts)
-                new_paths.append(processed_pre + "/" + post)
-                continue
-
-            if max_folders == 0:
-                new_paths.append(path)
-                continue
-
-            parts = path.split("/")
-            new_parts = []
-
-            is_absolute = path.startswith('/')
-            limit = 0
-            if max_folders > 0:
-                limit = max_folders + 1 if is_absolute else max_folders
+        rules = self._get_rules()
+        tags = self._get_tags()
+        if tags and songs is not None and len(songs) == len(paths):
+            choices_of = rules.choices_of
+
+            def chooser(index):
+                song = self._as_song(songs[index])
+                components = tag_components(song, tags) if song else {}
+
+                def choose(part):
+                    values = components.get(part)
+                    return None if values is None else choices_of(values)
+                return choose
+        else:
+            choices = rules.choices
+
+            def chooser(index):
+                return choices
+
+        def prune(index, path):
+            return self._prune(path, max_folders, chooser(index))
+
+        if len(paths) <= self.CHUNK_SIZE:
+            new_paths = [prune(index, path) for index, path in enumerate(paths)]
+        else:
+            new_paths = self._filter_in_chunks(paths, prune)
+            if new_paths is None:
+                return paths
+        return self._avoid_clashes(paths, new_paths, max_folders, chooser)
+
+    def _avoid_clashes(self, paths, new_paths, max_folders, chooser):
+        """Finds the paths clashing with a previous one with a hash index,
+        and prunes them with other values when possible"""
+        if self._is_case_insensitive():
+            fold = str.casefold
+        else:
+            def fold(path):
+                return path
+
+        taken = {}
+        clashes = []
+        for index, path in enumerate(new_paths):
+            key = fold(path)
+            if key in taken:
+                clashes.append(index)
             else:
-                limit = len(parts) - 1 + max_folders
-
-            for i, part in enumerate(parts):
-                if i < limit and i < len(parts) - 1:
-                    best_value = self._get_best_value(
-                        part, priority_words, avoid_words)
-                    new_parts.append(best_value)
-                else:
-                    new_parts.append(part)
+                taken[key] = index
+
+        unresolved = 0
+        for index in clashes:
+            for path in self._alternatives(
+                    paths[index], max_folders, chooser(index)):
+                key = fold(path)
+                if key not in taken:
+                    taken[key] = index
+                    new_paths[index] = path
+                    break
+            else:
+                unresolved += 1
+
+        if clashes:
+            text = _("%(avoided)d clashes avoided, %(left)d left") % {
+                "avoided": len(clashes) - unresolved, "left": unresolved}
+            print_d(f"PathPrune: {text}")
+            self._clashes_label.set_text(text)
+            self._clashes_label.show()
+        else:
+            self._clashes_label.hide()
+        return new_paths
 
-            new_path = "/".join(new_parts)
-            new_paths.append(new_path)
+    def _filter_in_chunks(self, paths, prune):
+        """Prunes the paths chunk by chunk, keeping the dialog responsive.
+
+        The rename API expects the paths back, so pending events are handled
+        between chunks. Only this box gets input meanwhile: the Cancel button
+        or a new number stops the pruning. Returns None then, the paths are
+        left as they are and the preview is marked as outdated once it is
+        done, so that it can't be saved half pruned.
+        """
+        self._cancelled = False
+        self._filtering = True
+        self._progress.set_fraction(0)
+        self._progress.show()
+        self._cancel_button.show()
+        Gtk.grab_add(self)
 
+        new_paths = []
+        total = len(paths)
+        try:
+            for start in range(0, total, self.CHUNK_SIZE):
+                if self._cancelled:
+                    break
+                for index in range(start, min(start + self.CHUNK_SIZE, total)):
+                    new_paths.append(prune(index, paths[index]))
+                self._progress.set_fraction(len(new_paths) / total)
+                self._progress.set_text(
+                    _("%(done)d / %(total)d paths")
+                    % {"done": len(new_paths), "total": total})
+                while Gtk.events_pending():
+                    Gtk.main_iteration()
+        finally:
+            self._filtering = False
+            Gtk.grab_remove(self)
+            self._progress.hide()
+            self._cancel_button.hide()
+
+        if self._cancelled:
+            print_d(f"PathPrune: Cancelled after {len(new_paths)} paths.")
+            # The preview sets the Save button once we return
+            GLib.idle_add(self._outdate_preview)
+            return None
         return new_paths
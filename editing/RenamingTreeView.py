@@ -3,14 +3,19 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import bisect
+import locale
 import os
+import re
+import threading
+import time
 
-from gi.repository import Gtk, GObject
+from gi.repository import Gtk, GObject, GLib, Pango
 from senf import fsn2text, text2fsn
 
-from quodlibet import _, config
+from quodlibet import _, ngettext, config
 from quodlibet.plugins.editing import RenameFilesPlugin
-from quodlibet.util import print_d
+from quodlibet.util import print_d, format_size
 from quodlibet.qltk import Icons
 from quodlibet.qltk.views import TreeViewColumn
 from quodlibet.qltk.renamefiles import RenameFiles
@@ -27,26 +32,214 @@ def find_ancestor_by_class(widget, target_class):
     return None
 
 
-def _case_insensitive_sort(model, iter1, iter2, user_data):
+_DIGITS = re.compile(r"(\d+)")
+
+
+def collation_key(name):
+    """
+    Sort key of a row name: case-insensitive, following the collation of
+    the locale, and with numbers compared by value ("Disc 2" < "Disc 10").
+    """
+    parts = _DIGITS.split(name.casefold())
+    # Text at even indexes and numbers at odd ones, so keys always compare
+    return tuple(int(part) if i % 2 else locale.strxfrm(part)
+                 for i, part in enumerate(parts))
+
+
+class DirectoryCache:
+    """Subfolders of the directories listed recently.
+
+    Probing the folders of a preview takes one os.scandir per parent
+    directory instead of a stat per folder, and none at all for the
+    previews made within TTL seconds. Used from a worker thread.
+    """
+
+    TTL = 30
+
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def cached(self, path):
+        """Tells if a folder exists from the cache only, None if unknown"""
+        if os.path.dirname(path) == path:
+            return True
+        with self._lock:
+            listing = self._listings.get(os.path.dirname(path) or os.curdir)
+        if listing is None or time.monotonic() - listing[0] >= self.TTL:
+            return None
+        return listing[1] is not None and os.path.basename(path) in listing[1]
+
+    def probe(self, paths):
+        """Returns whether each folder exists"""
+        now = time.monotonic()
+        result = {}
+        # Parents first: the children of a missing folder are missing too
+        for path in sorted(paths, key=len):
+            parent = os.path.dirname(path)
+            if parent == path:
+                result[path] = True
+            elif result.get(parent) is False:
+                result[path] = False
+            else:
+                subdirs = self._subdirs(parent or os.curdir, now)
+                result[path] = (subdirs is not None
+                                and os.path.basename(path) in subdirs)
+        return result
+
+    def _subdirs(self, directory, now):
+        with self._lock:
+            listing = self._listings.get(directory)
+        if listing is not None and now - listing[0] < self.TTL:
+            return listing[1]
+        try:
+            with os.scandir(text2fsn(directory)) as entries:
+                subdirs = frozenset(
+                    fsn2text(e.name) for e in entries if e.is_dir())
+        except OSError:
+            subdirs = None
+        with self._lock:
+            self._listings[directory] = (now, subdirs)
+        return subdirs
+
+
+DIRECTORIES = DirectoryCache()
+
+
+def move_cost(source, target, devices):
     """
-    Custom Gtk.TreeModel sort function for case-insensitive string comparison.
-    Sorts based on column 0 (the display name).
+    Returns the size of a file and whether moving it to target crosses
+    devices, which makes the rename a full copy. The device of a target is
+    the one of its nearest existing ancestor, `devices` caches them by
+    folder.
     """
     try:
-        val1 = model.get_value(iter1, 0)
-        val2 = model.get_value(iter2, 0)
-    except Exception:
-        return 0
+        stat = os.stat(source)
+    except OSError:
+        return 0, False
+    folder = os.path.dirname(text2fsn(target))
+    if not os.path.isabs(folder):
+        folder = os.path.join(os.path.dirname(source), folder)
+    missing = []
+    while folder not in devices:
+        try:
+            devices[folder] = os.stat(folder).st_dev
+        except OSError:
+            missing.append(folder)
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                devices[folder] = None
+            folder = parent
+    device = devices[folder]
+    for folder in missing:
+        devices[folder] = device
+    return stat.st_size, device is not None and device != stat.st_dev
+
+
+class NameIndex:
+    """
+    Folder and file names of a preview, for the search: sorted for the
+    prefixes of one or two characters, and by trigram for the substrings.
+    """
 
-    s1 = (val1 or "").lower()
-    s2 = (val2 or "").lower()
+    def __init__(self, names):
+        # folded name -> items
+        self._items = {}
+        for name, item in names:
+            self._items.setdefault(name.casefold(), []).append(item)
+        self._sorted = sorted(self._items)
+        self._trigrams = {}
+        for name in self._items:
+            for i in range(len(name) - 2):
+                self._trigrams.setdefault(name[i:i + 3], set()).add(name)
+
+    def search(self, text):
+        """Returns the items whose name contains text, or starts with it if
+        it's shorter than a trigram"""
+        text = text.casefold()
+        if len(text) < 3:
+            names = []
+            for name in self._sorted[bisect.bisect_left(self._sorted, text):]:
+                if not name.startswith(text):
+                    break
+                names.append(name)
+        else:
+            sets = [self._trigrams.get(text[i:i + 3], set())
+                    for i in range(len(text) - 2)]
+            sets.sort(key=len)
+            names = sets[0].intersection(*sets[1:])
+            if len(text) > 3:
+                # The trigrams can be at other places
+                names = [name for name in names if text in name]
+        return [item for name in names for item in self._items[name]]
+
+
+class FolderNode:
+    """A folder of the preview, in a trie of all the target paths.
+
+    Tree rows only exist for the children of the folders that were
+    expanded once (populated); a folder with content but not populated
+    yet has a single placeholder row so that it can be expanded.
+    The rows are kept in the order of their sort items, the model itself
+    is not sorted.
+    """
 
-    if s1 < s2:
-        return -1
-    elif s1 > s2:
-        return 1
-    else:
-        return 0
+    __slots__ = ("path", "name", "key", "parent", "folders", "files", "icon",
+                 "iter", "populated", "rows", "cost")
+
+    def __init__(self, path, name, parent, icon):
+        self.path = path
+        self.name = name
+        self.key = collation_key(name)
+        self.parent = parent
+        # name -> FolderNode
+        self.folders = {}
+        # source filename -> [filename, entry, iter, collation key,
+        #                     (size, crosses devices) once stat'ed]
+        self.files = {}
+        self.icon = icon
+        self.iter = None
+        self.populated = False
+        # Sorted items of the rows of the children, once populated
+        self.rows = []
+        # Files, bytes and moves across devices, subfolders included
+        self.cost = [0, 0, 0]
+
+    def cost_text(self):
+        files, size, crosses = self.cost
+        text = ngettext("%d file", "%d files", files) % files
+        text += ", " + format_size(size)
+        if crosses:
+            text += ", " + ngettext("%d across devices",
+                                    "%d across devices", crosses) % crosses
+        return text
+
+    @staticmethod
+    def file_cost_text(file):
+        if file[4] is None:
+            return ""
+        size, crosses = file[4]
+        if crosses:
+            return _("%s, across devices") % format_size(size)
+        return format_size(size)
+
+    def sort_item(self):
+        return (self.key, self.name, 0, "")
+
+    @staticmethod
+    def file_sort_item(source, file):
+        return (file[3], file[0], 1, source)
+
+    def is_empty(self):
+        return not self.folders and not self.files
+
+    def depth(self):
+        depth = 0
+        node = self.parent
+        while node is not None:
+            depth += 1
+            node = node.parent
+        return depth
 
 
 class RenamingTreeView(Gtk.Box, RenameFilesPlugin):
@@ -57,10 +250,41 @@ class RenamingTreeView(Gtk.Box, RenameFilesPlugin):
 
     __gsignals__ = {"changed": (GObject.SignalFlags.RUN_LAST, None, ())}
 
+    # Icon of the folders until we know if they exist
+    PROBING_ICON = "image-loading"
+
+    # Rows created at most by expanding the new folders of a preview
+    AUTO_EXPAND_ROWS = 5000
+
+    # Row of the not yet populated folders
+    PLACEHOLDER = ["", None, None, None, "", Pango.Weight.NORMAL]
+
+    # Files stat'ed by the move planner between two updates of the tree
+    STAT_BATCH = 500
+
     def __init__(self):
         super().__init__()
         self.rename_pane = None
         self.initialized = False
+        self._probe_generation = 0
+        # Trie of the last preview, folder path -> node, and source
+        # filename -> (target path, node)
+        self._root = self.__new_root()
+        self._folders = {}
+        self._files = {}
+        self._rows_created = 0
+        # Folders whose cost changed since their row was updated
+        self._dirty = set()
+        # Folders whose icon is waiting for the probe
+        self._probing = set()
+        # Index of the names of the preview, built in a thread after it
+        self._index = None
+        # (matching folders, matching sources, folders shown) while
+        # searching
+        self._search = None
+        self._search_text = ""
+        # Folders expanded before the search, expanded again after it
+        self._expanded = None
         self.connect("realize", self._on_realize)
 
     def _on_realize(self, widget):
@@ -96,25 +320,33 @@ class RenamingTreeView(Gtk.Box, RenameFilesPlugin):
         self.rename_pane.stack.child_set_property(
             original_sw, "icon-name", "view-list-symbolic")
 
-        self.fs_tstore = Gtk.TreeStore(str, str, object)
-
-        self.fs_tstore.set_sort_func(0, _case_insensitive_sort, None)
-        self.fs_tstore.set_sort_column_id(0, Gtk.SortType.ASCENDING)
+        # Name, icon, entry (files), node (folders), cost, weight
+        # Rows are inserted in order, see FolderNode
+        self.fs_tstore = Gtk.TreeStore(str, str, object, object, str, int)
 
         self.fs_view = Gtk.TreeView(model=self.fs_tstore)
         self.fs_view.set_headers_visible(False)
         self.fs_view.set_has_tooltip(True)
         self.__add_fs_tree_columns()
         self.fs_view.connect("query-tooltip", self._on_fs_view_query_tooltip)
+        self.fs_view.connect("test-expand-row", self._on_test_expand_row)
+
+        search_entry = Gtk.SearchEntry()
+        search_entry.set_placeholder_text(_("Search folders and files"))
+        search_entry.connect("search-changed", self._on_search_changed)
 
         sw_tree = Gtk.ScrolledWindow()
         sw_tree.set_shadow_type(Gtk.ShadowType.IN)
         sw_tree.add(self.fs_view)
-        sw_tree.show_all()
 
-        self.rename_pane.stack.add_named(sw_tree, "tree")
+        tree_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        tree_box.pack_start(search_entry, False, False, 0)
+        tree_box.pack_start(sw_tree, True, True, 0)
+        tree_box.show_all()
+
+        self.rename_pane.stack.add_named(tree_box, "tree")
         self.rename_pane.stack.child_set_property(
-            sw_tree, "icon-name", "folder-visiting-symbolic")
+            tree_box, "icon-name", "folder-visiting-symbolic")
 
         self.rename_pane.pack_start(self.rename_pane.stack, True, True, 0)
         self.rename_pane.reorder_child(self.rename_pane.stack, 1)
@@ -125,25 +357,169 @@ class RenamingTreeView(Gtk.Box, RenameFilesPlugin):
 
     def _update_tree_view(self, button):
         """
-        Populates our tree view with data from the main list view model,
+        Updates our tree view with data from the main list view model,
         which has just been updated by the original preview handler.
-        """
 
-        self.fs_tstore.clear()
-        folder_iters = {}
+        Only the differences with the previous preview are applied, so that
+        the expanded rows and the scroll position are kept.
+        """
+        self._probe_generation += 1
+        self._rows_created = 0
+        self._index = None
 
         list_model = self.rename_pane.view.get_model()
         if len(list_model) == 0:
+            self.fs_tstore.clear()
+            self._root = self.__new_root()
+            self._folders.clear()
+            self._files.clear()
+            self._dirty.clear()
+            self._probing.clear()
+            self._search = None
+            self._expanded = None
             return
 
+        # Keyed by source path, entry.name is only the basename
+        entries = {}
         for row in list_model:
             entry = row[0]
-            self.__add_to_fs_tree(entry, folder_iters)
+            if entry.new_name:
+                entries[entry.song("~filename")] = entry
+
+        # Files gone or moved
+        for source, (path, node) in list(self._files.items()):
+            entry = entries.get(source)
+            if entry is None or entry.new_name != path:
+                self.__remove_from_fs_tree(source)
+
+        new_folders = []
+        for source, entry in entries.items():
+            if source not in self._files:
+                self.__add_to_fs_tree(source, entry, new_folders)
+
+        # Searched again once the index is built
+        if not self._search_text:
+            if len(list_model) <= 50:
+                for node in self._folders.values():
+                    self.__populate(node)
+                self.fs_view.expand_all()
+            else:
+                self.__expand_new_folders(new_folders)
+
+        self.__update_costs()
+        self._probe_folders()
+        self._plan_moves()
+        self._index_names()
+
+    def _probe_folders(self):
+        """Finds out which folders exist in a thread, their icons are
+        updated once it's done"""
+        unknown = list(self._probing)
+        if not unknown:
+            return
 
-        if len(list_model) <= 50:
-            self.fs_view.expand_all()
-        else:
-            self.fs_tstore.foreach(self._selectively_expand)
+        generation = self._probe_generation
+
+        def probe():
+            try:
+                result = DIRECTORIES.probe(unknown)
+            except Exception as e:
+                print_d(f"RenamingTreeView: Error probing folders: {e}")
+                result = {}
+            GLib.idle_add(self._apply_probe, generation, result)
+
+        threading.Thread(target=probe, daemon=True).start()
+
+    def _apply_probe(self, generation, result):
+        if generation != self._probe_generation:
+            # Another preview was made in the meantime, it probes again
+            return False
+        for path, exists in result.items():
+            if path in self._probing:
+                self._probing.discard(path)
+                node = self._folders[path]
+                node.icon = "folder" if exists else "folder-new"
+                if node.iter is not None:
+                    self.fs_tstore.set_value(node.iter, 1, node.icon)
+        return False
+
+    def _plan_moves(self):
+        """Finds out the size of the files not planned yet, and which ones
+        move across devices, in a thread; the tree is updated after each
+        batch"""
+        jobs = [(source, path) for source, (path, node) in self._files.items()
+                if node.files[source][4] is None]
+        if not jobs:
+            return
+
+        generation = self._probe_generation
+
+        def plan():
+            devices = {}
+            for start in range(0, len(jobs), self.STAT_BATCH):
+                if generation != self._probe_generation:
+                    return
+                try:
+                    result = {source: move_cost(source, target, devices)
+                              for source, target
+                              in jobs[start:start + self.STAT_BATCH]}
+                except Exception as e:
+                    print_d(f"RenamingTreeView: Error planning moves: {e}")
+                    return
+                GLib.idle_add(self._apply_costs, generation, result)
+
+        threading.Thread(target=plan, daemon=True).start()
+
+    def _apply_costs(self, generation, result):
+        if generation != self._probe_generation:
+            # Files still there get planned again with the next preview
+            return False
+        for source, cost in result.items():
+            path, node = self._files.get(source, (None, None))
+            if node is None or node.files[source][4] is not None:
+                continue
+            file = node.files[source]
+            file[4] = cost
+            if file[2] is not None:
+                self.fs_tstore.set_value(
+                    file[2], 4, FolderNode.file_cost_text(file))
+            self.__add_cost(node, 0, cost[0], int(cost[1]))
+        self.__update_costs()
+        return False
+
+    def _index_names(self):
+        """Builds the index of the names for the search in a thread, a
+        search typed in the meantime is applied once it's done"""
+        generation = self._probe_generation
+        folders = list(self._folders.values())
+        files = list(self._files.items())
+
+        def index():
+            names = [(node.name, node) for node in folders]
+            names += [(path.rsplit(os.path.sep, 1)[-1], source)
+                      for source, (path, _node) in files]
+            GLib.idle_add(self._apply_index, generation, NameIndex(names))
+
+        threading.Thread(target=index, daemon=True).start()
+
+    def _apply_index(self, generation, index):
+        if generation != self._probe_generation:
+            # Another preview was made in the meantime, it indexes again
+            return False
+        self._index = index
+        if self._search_text:
+            self.__apply_search()
+        return False
+
+    def _on_test_expand_row(self, view, iter_, path):
+        node = self.fs_tstore.get_value(iter_, 3)
+        if node is not None:
+            self.__populate(node)
+        return False
+
+    def _on_search_changed(self, entry):
+        self._search_text = entry.get_text().strip()
+        self.__apply_search()
 
     def _on_fs_view_query_tooltip(self, widget, x, y, keyboard_tip, tooltip):
         path_info = widget.get_path_at_pos(x, y)
@@ -156,30 +532,19 @@ class RenamingTreeView(Gtk.Box, RenameFilesPlugin):
             return True
         return False
 
-    def _selectively_expand(self, model, path, iter):
+    def __expand_new_folders(self, new_folders):
         """
-        Gtk.TreeStore.foreach() callback.
-        Expands a row (iter) if it's a folder that contains other folders.
-        Does not expand "leaf" directories (folders containing only files).
+        Expands the new folders that contain other folders, parents first.
+        Does not expand "leaf" directories (folders containing only files),
+        nor touch the folders of the previous preview. Stops once enough
+        rows were created, the others get populated when expanded.
         """
-        entry = model.get_value(iter, 2)
-        if entry is not None:
-            return False
-
-        child_iter = model.iter_children(iter)
-        is_parent_of_folder = False
-
-        while child_iter:
-            is_child_a_folder = model.get_value(child_iter, 2) is None
-            if is_child_a_folder:
-                is_parent_of_folder = True
+        for node in sorted(new_folders, key=FolderNode.depth):
+            if self._rows_created > self.AUTO_EXPAND_ROWS:
                 break
-            child_iter = model.iter_next(child_iter)
-
-        if is_parent_of_folder:
-            self.fs_view.expand_row(path, open_all=False)
-
-        return False
+            if node.folders and node.iter is not None:
+                self.fs_view.expand_row(
+                    self.fs_tstore.get_path(node.iter), open_all=False)
 
     def __add_fs_tree_columns(self):
         col = TreeViewColumn()
@@ -189,33 +554,256 @@ class RenamingTreeView(Gtk.Box, RenameFilesPlugin):
         col.pack_start(cell_text, True)
         col.add_attribute(cell_pixbuf, "icon-name", 1)
         col.add_attribute(cell_text, "text", 0)
+        col.add_attribute(cell_text, "weight", 5)
         self.fs_view.append_column(col)
 
-    def __add_to_fs_tree(self, entry, folder_iters):
-        path = entry.new_name
-        if not path:
-            return
+        col = TreeViewColumn()
+        cell_cost = Gtk.CellRendererText()
+        cell_cost.set_property("sensitive", False)
+        cell_cost.set_property("xalign", 1.0)
+        col.pack_start(cell_cost, True)
+        col.add_attribute(cell_cost, "text", 4)
+        self.fs_view.append_column(col)
 
+    def __folders_of(self, path):
+        """Returns the (path, display name) of the folders of a target path,
+        outermost first, and its filename"""
         parts = path.split(os.path.sep)
         if os.path.isabs(path) and parts and parts[0] == "":
             parts[0] = os.path.sep
 
-        parent_iter = None
+        folders = []
         current_path = ""
-
         for part in parts[:-1]:
             if not part:
                 continue
             current_path = os.path.join(current_path, part) if part != os.path.sep else os.path.sep
+            display_name = part if current_path != os.path.sep else os.path.sep
+            folders.append((current_path, display_name))
+        return folders, parts[-1]
+
+    def __new_root(self):
+        root = FolderNode("", "", None, None)
+        root.populated = True
+        return root
+
+    def __insert_row(self, parent, item, row):
+        """Inserts a row at its sorted place among the rows of a populated
+        folder"""
+        position = bisect.bisect(parent.rows, item)
+        parent.rows.insert(position, item)
+        self._rows_created += 1
+        return self.fs_tstore.insert(parent.iter, position, row)
+
+    def __remove_row(self, parent, item, iter_):
+        del parent.rows[bisect.bisect_left(parent.rows, item)]
+        self.fs_tstore.remove(iter_)
+
+    def __add_cost(self, node, files, size, crosses):
+        """Adds to the cost of a folder and of its parents"""
+        while node is not None:
+            node.cost[0] += files
+            node.cost[1] += size
+            node.cost[2] += crosses
+            self._dirty.add(node)
+            node = node.parent
+
+    def __update_costs(self):
+        for node in self._dirty:
+            if node.iter is not None:
+                self.fs_tstore.set_value(node.iter, 4, node.cost_text())
+        self._dirty.clear()
+
+    def __weight(self, item, kind):
+        """Matches of the search are bold, kind 0 for folders, 1 for files"""
+        if self._search is not None and item in self._search[kind]:
+            return Pango.Weight.BOLD
+        return Pango.Weight.NORMAL
+
+    def __folder_row(self, node):
+        return [node.name, node.icon, None, node, node.cost_text(),
+                self.__weight(node, 0)]
+
+    def __file_row(self, source, file):
+        return [file[0], "audio-x-generic", file[1], None,
+                FolderNode.file_cost_text(file), self.__weight(source, 1)]
+
+    def __apply_search(self):
+        """
+        Shows the names containing the searched text and their folders only,
+        the matching folders keep all their content. The folders leading to
+        the matches are expanded, parents first, until AUTO_EXPAND_ROWS rows
+        were created; the others are populated when expanded.
+        Without search, the folders expanded before it are expanded again.
+        """
+        if not self._search_text:
+            if self._search is not None:
+                self._search = None
+                self.__reset_rows()
+                self.__expand_folders(self._expanded or [])
+            self._expanded = None
+            return
 
-            if current_path in folder_iters:
-                parent_iter = folder_iters[current_path]
+        if self._index is None:
+            # Not built yet, it searches once it is
+            return
+        if self._search is None:
+            self._expanded = self.__expanded_folders()
+
+        folders = set()
+        sources = set()
+        parents = []
+        for item in self._index.search(self._search_text):
+            if isinstance(item, FolderNode):
+                folders.add(item)
+                parents.append(item.parent)
+            else:
+                sources.add(item)
+                parents.append(self._files[item][1])
+
+        # Folders leading to the matches
+        ancestors = set()
+        for node in parents:
+            while node is not self._root and node not in ancestors:
+                ancestors.add(node)
+                node = node.parent
+
+        self._search = (folders, sources, folders | ancestors)
+        self.__reset_rows()
+        for node in sorted(ancestors, key=FolderNode.depth):
+            if self._rows_created > self.AUTO_EXPAND_ROWS:
+                break
+            if node.iter is not None:
+                self.fs_view.expand_row(
+                    self.fs_tstore.get_path(node.iter), open_all=False)
+
+    def __expanded_folders(self):
+        return [node for node in self._folders.values()
+                if node.populated and node.iter is not None
+                and self.fs_view.row_expanded(
+                    self.fs_tstore.get_path(node.iter))]
+
+    def __expand_folders(self, nodes):
+        """Expands the folders still in the preview, parents first"""
+        for node in sorted(nodes, key=FolderNode.depth):
+            if self._folders.get(node.path) is node and node.iter is not None:
+                self.fs_view.expand_row(
+                    self.fs_tstore.get_path(node.iter), open_all=False)
+
+    def __reset_rows(self):
+        """Recreates the rows of the first level, for another search"""
+        self.fs_tstore.clear()
+        self._rows_created = 0
+        for node in [self._root] + list(self._folders.values()):
+            node.iter = None
+            node.populated = False
+            node.rows = []
+            for file in node.files.values():
+                file[2] = None
+        self.__populate(self._root)
+
+    def __is_searched(self, node):
+        """Whether a folder is in a matching folder, where all is shown"""
+        while node is not None:
+            if node in self._search[0]:
+                return False
+            node = node.parent
+        return True
+
+    def __materialize(self, node, iter_=None):
+        """Adds the row of a folder, whose parent is populated"""
+        if iter_ is None:
+            iter_ = self.__insert_row(node.parent, node.sort_item(),
+                                      self.__folder_row(node))
+        node.iter = iter_
+        if not node.is_empty():
+            self.fs_tstore.append(node.iter, self.PLACEHOLDER)
+
+    def __populate(self, node):
+        """Replaces the placeholder of a folder by the rows of its content,
+        appended in order"""
+        if node.populated or (node.iter is None and node is not self._root):
+            # Hidden by the search
+            return
+        node.populated = True
+        placeholder = self.fs_tstore.iter_children(node.iter)
+
+        folders = node.folders.values()
+        files = node.files.items()
+        if self._search is not None and self.__is_searched(node):
+            folders = [child for child in folders if child in self._search[2]]
+            files = [(source, file) for source, file in files
+                     if source in self._search[1]]
+        children = [(child.sort_item(), child) for child in folders]
+        children += [(FolderNode.file_sort_item(source, file), source)
+                     for source, file in files]
+        children.sort(key=lambda child: child[0])
+        node.rows = [item for item, child in children]
+
+        for item, child in children:
+            if isinstance(child, FolderNode):
+                self.__materialize(child, self.fs_tstore.append(
+                    node.iter, self.__folder_row(child)))
             else:
-                icon_name = "folder" if os.path.isdir(text2fsn(current_path)) else "folder-new"
-                display_name = part if current_path != os.path.sep else os.path.sep
-                parent_iter = self.fs_tstore.append(
-                    parent_iter, [display_name, icon_name, None])
-                folder_iters[current_path] = parent_iter
-
-        filename = parts[-1]
-        self.fs_tstore.append(parent_iter, [filename, "audio-x-generic", entry])
+                file = node.files[child]
+                file[2] = self.fs_tstore.append(
+                    node.iter, self.__file_row(child, file))
+        self._rows_created += len(children)
+        if placeholder is not None:
+            self.fs_tstore.remove(placeholder)
+
+    def __remove_from_fs_tree(self, source):
+        """Removes a file, and the folders it leaves empty"""
+        _path, node = self._files.pop(source)
+        file = node.files.pop(source)
+        if file[2] is not None:
+            self.__remove_row(
+                node, FolderNode.file_sort_item(source, file), file[2])
+        size, crosses = file[4] or (0, False)
+        self.__add_cost(node, -1, -size, -int(crosses))
+
+        while node is not self._root and node.is_empty():
+            parent = node.parent
+            del parent.folders[node.name]
+            del self._folders[node.path]
+            self._probing.discard(node.path)
+            if node.iter is not None:
+                self.__remove_row(parent, node.sort_item(), node.iter)
+                node.iter = None
+            node = parent
+
+    def __add_to_fs_tree(self, source, entry, new_folders):
+        path = entry.new_name
+        folders, filename = self.__folders_of(path)
+        node = self._root
+        first_new = None
+
+        for current_path, display_name in folders:
+            child = node.folders.get(display_name)
+            if child is None:
+                exists = DIRECTORIES.cached(current_path)
+                if exists is None:
+                    icon_name = self.PROBING_ICON
+                    self._probing.add(current_path)
+                else:
+                    icon_name = "folder" if exists else "folder-new"
+                child = FolderNode(current_path, display_name, node, icon_name)
+                node.folders[display_name] = child
+                self._folders[current_path] = child
+                new_folders.append(child)
+                first_new = first_new or child
+            node = child
+
+        file = [filename, entry, None, collation_key(filename), None]
+        node.files[source] = file
+        self._files[source] = (path, node)
+        self.__add_cost(node, 1, 0, 0)
+
+        if first_new is not None:
+            # Only the outermost new folder can have a row yet
+            if first_new.parent.populated:
+                self.__materialize(first_new)
+        elif node.populated:
+            file[2] = self.__insert_row(
+                node, FolderNode.file_sort_item(source, file),
+                self.__file_row(source, file))
@@ -5,17 +5,27 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import json
 import operator
+import os
+import threading
+import weakref
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from itertools import chain, compress
 
-from gi.repository import Gtk, GdkPixbuf, Gio
+from gi.repository import Gtk, Gdk, GdkPixbuf, Gio, GLib
 
 from quodlibet import _
 from quodlibet import app
+from quodlibet import get_user_dir
 from quodlibet.plugins import PluginConfig
 from quodlibet.plugins.events import EventPlugin
 from quodlibet.browsers.paned.pane import Pane
-from quodlibet.browsers.paned.models import PaneModel, AllEntry
-from quodlibet.qltk import Icons, print_d
+from quodlibet.browsers.paned.models import PaneModel, AllEntry, UnknownEntry
+from quodlibet.qltk import Icons, get_top_parent, print_d
+from quodlibet.qltk.getstring import GetStringDialog
 
 # AND: Intersection style
 ICON_AND = (
@@ -53,6 +63,1243 @@ ICON_OR = (
 plugin_config = PluginConfig("conjunction")
 defaults = plugin_config.defaults
 defaults.set("state", "||")
+# Per-pane overrides of the state, comma-separated, empty for the default
+defaults.set("pane_states", "")
+
+# Key of the membership of songs without any value for a pane pattern
+UNKNOWN_KEY = object()
+
+# Turns the digits of bin() into bytes usable as flags by compress()
+BIN_FLAGS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def bitmap_from_ids(ids):
+    """Builds a bitmap (a Python int) with the bits of the given ids set"""
+    if len(ids) < 64:
+        bits = 0
+        for i in ids:
+            bits |= 1 << i
+        return bits
+    buf = bytearray((max(ids) >> 3) + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, "little")
+
+
+def walk_order(bits, order, songs):
+    """Returns the songs of `bits` in the order of `order`, a list of ids"""
+    flags = bin(bits)[:1:-1].ljust(len(songs), "0")
+    return [songs[i] for i in order if flags[i] == "1"]
+
+
+def entry_key(entry):
+    """Returns the membership key matching a pane entry"""
+    if isinstance(entry, UnknownEntry):
+        return UNKNOWN_KEY
+    return entry.key
+
+
+def song_keys(config, song):
+    """Returns the membership keys of a song for a pane pattern"""
+    keys = {key for key, _sort in config.format(song)}
+    return tuple(keys) or (UNKNOWN_KEY,)
+
+
+class PaneMembership:
+    """Songs ids under each key of a pane pattern, for the whole library.
+
+    Ids are kept in sets so that library changes are cheap to apply, and
+    bitmaps are only built for the keys that are actually queried.
+    """
+
+    MAX_BITMAPS = 256
+
+    def __init__(self, config):
+        self._config = config
+        self._ids = {}
+        self._song_keys = {}
+        self._versions = {}
+        self._bitmaps = OrderedDict()
+
+    def keys_of(self, song):
+        return song_keys(self._config, song)
+
+    def add(self, song_id, song):
+        keys = self.keys_of(song)
+        self._song_keys[song_id] = keys
+        versions = self._versions
+        for key in keys:
+            versions[key] = versions.get(key, 0) + 1
+            self._ids.setdefault(key, set()).add(song_id)
+            if key in self._bitmaps:
+                self._bitmaps[key] |= 1 << song_id
+
+    def remove(self, song_id):
+        versions = self._versions
+        for key in self._song_keys.pop(song_id, ()):
+            versions[key] += 1
+            ids = self._ids[key]
+            ids.discard(song_id)
+            if not ids:
+                del self._ids[key]
+                self._bitmaps.pop(key, None)
+            elif key in self._bitmaps:
+                self._bitmaps[key] &= ~(1 << song_id)
+
+    def count(self, key):
+        return len(self._ids.get(key, ()))
+
+    def ids(self, key):
+        return self._ids.get(key, frozenset())
+
+    def operand(self, key):
+        """Returns the songs of a key as an immutable value: its bitmap if
+        already built, a copy of its ids otherwise"""
+        bits = self._bitmaps.get(key)
+        if bits is not None:
+            return bits
+        return frozenset(self._ids.get(key, ()))
+
+    def has_bitmap(self, key):
+        return key in self._bitmaps
+
+    def count_keys(self, ids):
+        """Counts the songs under each key among the given ids, in one pass"""
+        return Counter(chain.from_iterable(
+            filter(None, map(self._song_keys.get, ids))))
+
+    def version(self, key):
+        """Returns a number changing each time the songs of `key` change"""
+        return self._versions.get(key, 0)
+
+    def bitmap(self, key):
+        bits = self._bitmaps.get(key)
+        if bits is None:
+            bits = bitmap_from_ids(self._ids.get(key, ()))
+            self._bitmaps[key] = bits
+            if len(self._bitmaps) > self.MAX_BITMAPS:
+                self._bitmaps.popitem(last=False)
+        else:
+            self._bitmaps.move_to_end(key)
+        return bits
+
+
+class SongBitmapIndex:
+    """Gives each song of the library a dense integer id, so that pane
+    entries can be combined with bitwise operations on Python ints.
+
+    Memberships only depend on the library and the pane patterns: they are
+    kept up to date from the library signals. The songs currently shown in
+    a pane (its universe) are kept up to date as songs are added to and
+    removed from the pane model, as songs so that "All" is always at hand,
+    and as a bitmap for the other selections.
+
+    The ids are also kept ranked by song sort key, so that a sorted list of
+    songs can be read from a bitmap by walking the ranking, without sorting.
+    """
+
+    # Above this many changed songs, the ranking is rebuilt at once
+    MAX_RANK_UPDATES = 2000
+
+    def __init__(self):
+        self._library = None
+        self._sig_ids = []
+        self._ids = {}
+        self._songs = []
+        self._free = []
+        self._memberships = weakref.WeakKeyDictionary()
+        self._universes = weakref.WeakKeyDictionary()
+        # model -> [frozenset of its songs, same sorted or None]
+        self._universe_songs = weakref.WeakKeyDictionary()
+        self._contents = weakref.WeakKeyDictionary()
+        self._handover = (None, 0)
+        self._order = None
+        self._order_keys = []
+        self._rank_keys = {}
+
+    def connect(self, library):
+        self.disconnect()
+        self._library = library
+        self._sig_ids = [
+            library.connect("added", self._on_added),
+            library.connect("changed", self._on_changed),
+            library.connect("removed", self._on_removed),
+        ]
+
+    def disconnect(self):
+        if self._library is not None:
+            for sig_id in self._sig_ids:
+                self._library.disconnect(sig_id)
+        self._library = None
+        self._sig_ids = []
+        self._ids.clear()
+        self._songs.clear()
+        self._free.clear()
+        self._memberships.clear()
+        self._universes.clear()
+        self._universe_songs.clear()
+        self._handover = (None, 0)
+        self._order = None
+
+    def song_id(self, song):
+        song_id = self._ids.get(song)
+        if song_id is None:
+            if self._free:
+                song_id = self._free.pop()
+                self._songs[song_id] = song
+            else:
+                song_id = len(self._songs)
+                self._songs.append(song)
+            self._ids[song] = song_id
+            if self._order is not None:
+                self._rank_insert(song_id, song.sort_key)
+        return song_id
+
+    def bits_of(self, songs):
+        return bitmap_from_ids(self.ids_of_songs(songs))
+
+    def ids_of_songs(self, songs):
+        song_id = self.song_id
+        return [song_id(song) for song in songs]
+
+    def ids_of(self, bits):
+        # Lowest id first, scanning the digits of bin() is much faster than
+        # shifting; dense bitmaps are selected in C, without a Python loop
+        flags = bin(bits)[:1:-1]
+        if bits.bit_count() * 8 > len(flags):
+            flags = flags.encode("ascii").translate(BIN_FLAGS)
+            return list(compress(range(len(flags)), flags))
+        result = []
+        index = flags.find("1")
+        while index != -1:
+            result.append(index)
+            index = flags.find("1", index + 1)
+        return result
+
+    def songs_of(self, bits):
+        songs = self._songs
+        return [songs[i] for i in self.ids_of(bits)]
+
+    def sorted_songs_of(self, bits):
+        """Same as songs_of, sorted by song sort key"""
+        count = bits.bit_count()
+        if count * max(1, count.bit_length()) * 8 < len(self._ids):
+            # Small results are cheaper to sort than to walk the ranking
+            return sorted(
+                self.songs_of(bits), key=operator.attrgetter("sort_key"))
+        return walk_order(bits, self.order(), self._songs)
+
+    def order(self):
+        """Returns all the ids, ranked by song sort key"""
+        if self._order is None:
+            keys = {
+                i: song.sort_key
+                for i, song in enumerate(self._songs) if song is not None
+            }
+            self._order = sorted(keys, key=keys.__getitem__)
+            self._order_keys = [keys[i] for i in self._order]
+            self._rank_keys = keys
+        return self._order
+
+    def _rank_insert(self, song_id, key):
+        position = bisect_right(self._order_keys, key)
+        self._order.insert(position, song_id)
+        self._order_keys.insert(position, key)
+        self._rank_keys[song_id] = key
+
+    def _rank_remove(self, song_id):
+        key = self._rank_keys.pop(song_id, None)
+        if key is None:
+            return
+        position = bisect_left(self._order_keys, key)
+        while self._order[position] != song_id:
+            position += 1
+        del self._order[position]
+        del self._order_keys[position]
+
+    def _update_ranks(self, songs, removed=False):
+        if self._order is None:
+            return
+        if len(songs) > self.MAX_RANK_UPDATES:
+            self._order = None
+            return
+        for song in songs:
+            song_id = self._ids.get(song)
+            if song_id is None:
+                continue
+            self._rank_remove(song_id)
+            if not removed:
+                self._rank_insert(song_id, song.sort_key)
+
+    def snapshot(self):
+        """Returns a copy of the id to song table"""
+        return list(self._songs)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def membership(self, model):
+        membership = self._memberships.get(model)
+        if membership is None:
+            membership = PaneMembership(model.config)
+            if self._library is not None:
+                song_id = self.song_id
+                for song in self._library.values():
+                    membership.add(song_id(song), song)
+            self._memberships[model] = membership
+        return membership
+
+    def universe(self, model):
+        """Returns the bitmap of all the songs of a pane"""
+        bits = self._universes.get(model)
+        if bits is None:
+            bits = self.bits_of(self.universe_songs(model))
+            self._universes[model] = bits
+        return bits
+
+    def universe_songs(self, model, sort=False):
+        """Returns all the songs of a pane, as a frozenset, or as a list
+        sorted by song sort key"""
+        cached = self._universe_songs.get(model)
+        if cached is None:
+            songs = set()
+            for entry in model.itervalues():
+                songs.update(entry.songs)
+            cached = self._universe_songs[model] = [frozenset(songs), None]
+        if not sort:
+            return cached[0]
+        if cached[1] is None:
+            cached[1] = sorted(cached[0], key=operator.attrgetter("sort_key"))
+        return list(cached[1])
+
+    def contents_version(self, model):
+        """Returns a number changing each time songs are added to or removed
+        from a pane"""
+        return self._contents.get(model, 0)
+
+    def hand_over(self, songs, bits):
+        """Remembers the bitmap of the selected songs of a pane, which are
+        about to fill the next one, None if it wasn't computed"""
+        self._handover = (songs, bits)
+
+    def filling(self, model, songs):
+        """Called before songs are added to a pane model, keeps its universe
+        up to date. Returns the songs, as a collection.
+
+        When a pane is filled with the selection of the previous one, its
+        universe is already known and doesn't need to be computed again.
+        Otherwise it is only computed once a selection of the pane needs it.
+        """
+        if not isinstance(songs, (list, tuple, set, frozenset)):
+            songs = list(songs)
+        self._contents[model] = self.contents_version(model) + 1
+        handed_songs, bits = self._handover
+        self._handover = (None, 0)
+        if not len(model):
+            if songs is handed_songs and bits is not None:
+                self._universes[model] = bits
+            else:
+                self._universes.pop(model, None)
+            self._universe_songs[model] = [frozenset(songs), None]
+        else:
+            universe = self._universes.get(model)
+            if universe is not None:
+                self._universes[model] = universe | self.bits_of(songs)
+            cached = self._universe_songs.get(model)
+            if cached is not None:
+                self._universe_songs[model] = [cached[0].union(songs), None]
+        return songs
+
+    def removing(self, model, songs):
+        """Called before songs are removed from a pane model, same as
+        filling()"""
+        if not isinstance(songs, (list, tuple, set, frozenset)):
+            songs = list(songs)
+        self._contents[model] = self.contents_version(model) + 1
+        universe = self._universes.get(model)
+        if universe:
+            ids = self._ids
+            removed = bitmap_from_ids([ids[s] for s in songs if s in ids])
+            self._universes[model] = universe & ~removed
+        cached = self._universe_songs.get(model)
+        if cached is not None:
+            self._universe_songs[model] = [cached[0].difference(songs), None]
+        return songs
+
+    def _on_added(self, library, songs):
+        if len(songs) > self.MAX_RANK_UPDATES:
+            self._order = None
+        song_id = self.song_id
+        for membership in self._memberships.values():
+            for song in songs:
+                membership.add(song_id(song), song)
+
+    def _on_changed(self, library, songs):
+        self._update_ranks(songs)
+        for cached in self._universe_songs.values():
+            cached[1] = None
+        song_id = self.song_id
+        for membership in self._memberships.values():
+            for song in songs:
+                song_id_ = song_id(song)
+                membership.remove(song_id_)
+                membership.add(song_id_, song)
+
+    def _on_removed(self, library, songs):
+        self._update_ranks(songs, removed=True)
+        freed = []
+        for song in songs:
+            song_id = self._ids.pop(song, None)
+            if song_id is None:
+                continue
+            for membership in self._memberships.values():
+                membership.remove(song_id)
+            self._songs[song_id] = None
+            self._free.append(song_id)
+            freed.append(song_id)
+        # Freed ids will be reused, they can't stay in the universes
+        if freed:
+            mask = ~bitmap_from_ids(freed)
+            for model, bits in list(self._universes.items()):
+                self._universes[model] = bits & mask
+
+
+class SelectionPlan:
+    """Set operations of a pane selection, compiled once per selection:
+
+        universe & (k1 op k2 op ...) & ~(n1 | n2 | ...)
+
+    where `op` is the AND/OR mode of the pane, `k` the selected keys and `n`
+    the excluded ones. Each operand is a cached result of the query.
+    """
+
+    __slots__ = ("conjunction", "keys", "excluded")
+
+    def __init__(self, conjunction, has_all, keys, excluded):
+        self.conjunction = conjunction
+        # "All" makes a disjunction unconstrained, a conjunction ignores it
+        self.keys = keys if conjunction or not has_all else frozenset()
+        self.excluded = excluded
+
+    @property
+    def signature(self):
+        return (self.conjunction, self.keys, self.excluded)
+
+    def matches(self, keys):
+        """Tells if a song with the given membership keys is selected"""
+        if self.keys:
+            if self.conjunction:
+                if not self.keys.issubset(keys):
+                    return False
+            elif self.keys.isdisjoint(keys):
+                return False
+        return self.excluded.isdisjoint(keys)
+
+    def run(self, query, model, universe):
+        bits = universe
+        if self.keys:
+            if self.conjunction:
+                bits &= query.conjunction(model, self.keys)
+            else:
+                bits &= query.union(model, self.keys)
+        if self.excluded and bits:
+            bits &= ~query.union(model, self.excluded)
+        return bits
+
+
+class ConjunctionQuery:
+    """Evaluates pane selections on the bitmap index.
+
+    Conjunctions are computed over the whole library, smallest keys first,
+    and kept in a LRU cache along with the versions of the keys involved,
+    so that a result is only dropped when one of its keys changed. Results
+    are then restricted to the songs of the pane, which is a single AND.
+
+    The intermediate results of the last selection of each pane are kept
+    too, so that adding or removing a key doesn't start over, and so are
+    its facet counts until the selection or the songs of the pane change.
+    """
+
+    MAX_RESULTS = 64
+
+    def __init__(self, index):
+        self._index = index
+        self._results = OrderedDict()
+        self._plans = OrderedDict()
+        self._chains = weakref.WeakKeyDictionary()
+        self._counts = weakref.WeakKeyDictionary()
+
+    def clear(self):
+        self._results.clear()
+        self._plans.clear()
+        self._chains.clear()
+        self._counts.clear()
+
+    def evaluate(self, model, entries, conjunction, excluded=()):
+        """Returns the bitmap of the songs matching the selected entries"""
+        plan = self.plan(entries, conjunction, excluded)
+        return plan.run(self, model, self._index.universe(model))
+
+    def plan(self, entries, conjunction, excluded=()):
+        """Returns the compiled plan of a selection, cached by its keys"""
+        keys = [entry_key(e) for e in entries if not isinstance(e, AllEntry)]
+        has_all = len(keys) < len(entries)
+        plan_key = (conjunction, has_all, frozenset(keys), frozenset(excluded))
+        plan = self._plans.get(plan_key)
+        if plan is None:
+            plan = SelectionPlan(*plan_key)
+            self._plans[plan_key] = plan
+            if len(self._plans) > self.MAX_RESULTS:
+                self._plans.popitem(last=False)
+        else:
+            self._plans.move_to_end(plan_key)
+        return plan
+
+    def cost(self, model, plan, universe):
+        """Estimates the number of songs an evaluation has to go through:
+        keys without a bitmap yet, the songs of the result, and them again
+        for the facet counts unless they are cached"""
+        membership = self._index.membership(model)
+        count = membership.count
+        if plan.conjunction and plan.keys and self._cached(
+                membership, (model, "&", plan.keys)) is not None:
+            pending = 0
+        else:
+            pending = sum(
+                count(k) for k in plan.keys if not membership.has_bitmap(k))
+        pending += sum(
+            count(k) for k in plan.excluded if not membership.has_bitmap(k))
+
+        if not plan.keys:
+            result = universe.bit_count()
+        elif plan.conjunction:
+            result = min(count(k) for k in plan.keys)
+        else:
+            result = sum(count(k) for k in plan.keys)
+        if has_counts(plan) and self.cached_counts(model, plan) is None:
+            result *= 2
+        return pending + result
+
+    def snapshot(self, model, plan):
+        """Returns the operands of a plan and the versions of their keys,
+        for an evaluation outside of the main loop"""
+        membership = self._index.membership(model)
+        keys = plan.keys
+        cached = None
+        if plan.conjunction and keys:
+            cached = self._cached(membership, (model, "&", keys))
+        if cached is not None:
+            operands = [cached]
+        else:
+            ordered = sorted(keys, key=membership.count)
+            operands = [membership.operand(k) for k in ordered]
+        excluded = [membership.operand(k) for k in plan.excluded]
+        versions = tuple(
+            (k, membership.version(k)) for k in keys | plan.excluded)
+        return operands, excluded, versions
+
+    def is_current(self, model, versions):
+        membership = self._index.membership(model)
+        return all(membership.version(k) == v for k, v in versions)
+
+    def facet_counts(self, model, plan, ids):
+        """Returns the number of songs of the result of a plan under each key
+        of a pane; `ids` returns the ids of the result, only called when the
+        counts aren't cached"""
+        counts = self.cached_counts(model, plan)
+        if counts is None:
+            membership = self._index.membership(model)
+            counts = membership.count_keys(ids())
+            self.store_counts(model, plan, counts)
+        return counts
+
+    def cached_counts(self, model, plan):
+        cached = self._counts.get(model)
+        if cached is not None and cached[0] == self._counts_key(model, plan):
+            return cached[1]
+        return None
+
+    def store_counts(self, model, plan, counts):
+        self._counts[model] = (self._counts_key(model, plan), counts)
+
+    def _counts_key(self, model, plan):
+        # A song of the result changing any of its keys changes the versions
+        # of the keys of the plan too
+        membership = self._index.membership(model)
+        versions = frozenset(
+            (k, membership.version(k)) for k in plan.keys | plan.excluded)
+        return (plan.signature, versions,
+                self._index.contents_version(model))
+
+    def _cached(self, membership, cache_key):
+        cached = self._results.get(cache_key)
+        if cached is not None:
+            bits, versions = cached
+            if all(membership.version(k) == v for k, v in versions):
+                self._results.move_to_end(cache_key)
+                return bits
+            del self._results[cache_key]
+        return None
+
+    def _store(self, membership, cache_key, bits):
+        versions = tuple((key, membership.version(key)) for key in cache_key[2])
+        self._results[cache_key] = (bits, versions)
+        if len(self._results) > self.MAX_RESULTS:
+            self._results.popitem(last=False)
+
+    def union(self, model, keys):
+        """Returns the bitmap of the library songs having any of the keys"""
+        membership = self._index.membership(model)
+        cache_key = (model, "||", frozenset(keys))
+        bits = self._cached(membership, cache_key)
+        if bits is None:
+            bits = 0
+            for key in cache_key[2]:
+                bits |= membership.bitmap(key)
+            self._store(membership, cache_key, bits)
+        return bits
+
+    def conjunction(self, model, keys):
+        """Returns the bitmap of the library songs having all the keys"""
+        membership = self._index.membership(model)
+        cache_key = (model, "&", frozenset(keys))
+        bits = self._cached(membership, cache_key)
+        if bits is not None:
+            return bits
+
+        bits = self._from_chain(model, membership, cache_key[2])
+        if bits is None:
+            # Cost-based order: smallest keys first
+            ordered = sorted(cache_key[2], key=membership.count)
+            chain = self._chains[model] = []
+            bits = membership.bitmap(ordered[0])
+            chain.append((ordered[0], membership.version(ordered[0]), bits))
+            self._extend_chain(membership, chain, ordered[1:])
+            bits = chain[-1][2]
+
+        self._store(membership, cache_key, bits)
+        return bits
+
+    def _from_chain(self, model, membership, key_set):
+        """Reuses the intermediate results of the previous selection of the
+        pane if it shares a prefix with the new one: extending a selection
+        refines the previous result, reducing one returns an intermediate.
+        """
+        chain = self._chains.get(model)
+        if not chain:
+            return None
+
+        depth = 0
+        for key, version, _bits in chain:
+            if key not in key_set or membership.version(key) != version:
+                break
+            depth += 1
+        if not depth:
+            return None
+
+        del chain[depth:]
+        remaining = key_set.difference(key for key, _v, _b in chain)
+        self._extend_chain(
+            membership, chain, sorted(remaining, key=membership.count))
+        return chain[-1][2]
+
+    def _extend_chain(self, membership, chain, keys):
+        bits = chain[-1][2]
+        for key in keys:
+            bits = self._refine(membership, bits, key)
+            chain.append((key, membership.version(key), bits))
+
+    def _refine(self, membership, bits, key):
+        """ANDs `bits` with a key, in O(result) when `bits` is sparse"""
+        if bits.bit_count() * 64 < len(self._index):
+            key_ids = membership.ids(key)
+            return bitmap_from_ids(
+                [i for i in self._index.ids_of(bits) if i in key_ids])
+        return bits & membership.bitmap(key)
+
+
+def has_counts(plan):
+    """Facet counts are shown while a conjunction is selected"""
+    return plan.conjunction and bool(plan.keys)
+
+
+def as_bitmap(operand):
+    return operand if isinstance(operand, int) else bitmap_from_ids(operand)
+
+
+def run_operands(conjunction, universe, operands, excluded):
+    """Evaluates a plan from a snapshot of its operands, see SelectionPlan"""
+    bits = universe
+    if operands:
+        if conjunction:
+            for operand in operands:
+                if not bits:
+                    break
+                bits &= as_bitmap(operand)
+        else:
+            union = 0
+            for operand in operands:
+                union |= as_bitmap(operand)
+            bits &= union
+    if excluded and bits:
+        union = 0
+        for operand in excluded:
+            union |= as_bitmap(operand)
+        bits &= ~union
+    return bits
+
+
+class SelectionWorker:
+    """Evaluates large selections in a thread, so that the browser stays
+    responsive. The thread only works on a snapshot of the operands.
+
+    Each pane has a generation counter, only ever increasing, bumped by
+    every submitted or cancelled evaluation, and results of an older
+    generation are dropped when they come back. A
+    delivered result is kept until the selection changes, so that the
+    refresh it triggers (and later calls) get it right away.
+    """
+
+    THRESHOLD = 50000
+
+    def __init__(self, index, query):
+        self._index = index
+        self._query = query
+        self._generations = weakref.WeakKeyDictionary()
+        self._busy = weakref.WeakSet()
+        self._results = weakref.WeakKeyDictionary()
+
+    def clear(self):
+        for pane in list(self._busy):
+            self.cancel(pane)
+        self._results.clear()
+
+    def cancel(self, pane):
+        """Drops the evaluation running for a pane, if any"""
+        if pane in self._busy:
+            self._generations[pane] += 1
+            self._set_idle(pane)
+
+    def _set_idle(self, pane):
+        self._busy.discard(pane)
+        set_busy(pane, False)
+
+    def result(self, pane, model, plan, universe, sort):
+        """Returns the delivered (bits, songs, counts) of a selection"""
+        result = self._results.get(pane)
+        if result is None:
+            return None
+        signature, result_universe, versions, bits, songs, counts, is_sorted = \
+            result
+        if (signature != plan.signature or result_universe != universe
+                or not self._query.is_current(model, versions)):
+            del self._results[pane]
+            return None
+        if sort and not is_sorted:
+            songs = self._index.sorted_songs_of(bits)
+            self._results[pane] = result[:4] + (songs, counts, True)
+        return bits, list(songs), counts
+
+    def submit(self, pane, model, plan, universe, sort):
+        generation = self._generations.get(pane, 0) + 1
+        self._generations[pane] = generation
+        self._busy.add(pane)
+        self._results.pop(pane, None)
+
+        operands, excluded, versions = self._query.snapshot(model, plan)
+        membership = self._index.membership(model)
+        counts = self._query.cached_counts(model, plan)
+        order = list(self._index.order()) if sort else None
+        set_busy(pane, True)
+        thread = threading.Thread(
+            target=self._run,
+            args=(weakref.ref(pane), generation, plan, universe, order,
+                  operands, excluded, versions, membership, counts,
+                  self._index.snapshot()),
+            daemon=True)
+        thread.start()
+
+    def _run(self, pane_ref, generation, plan, universe, order,
+             operands, excluded, versions, membership, counts, songs_table):
+        sort = order is not None
+        try:
+            bits = run_operands(plan.conjunction, universe, operands, excluded)
+            ids = self._index.ids_of(bits)
+            if sort:
+                songs = walk_order(bits, order, songs_table)
+            else:
+                songs = [songs_table[i] for i in ids]
+            if counts is None and has_counts(plan):
+                counts = membership.count_keys(ids)
+            result = (plan.signature, universe, versions, bits, songs, counts,
+                      sort)
+        except Exception as e:
+            print_d(f"Conjunction Plugin: Error evaluating selection: {e}")
+            result = None
+        GLib.idle_add(self._deliver, pane_ref, generation, result)
+
+    def _deliver(self, pane_ref, generation, result):
+        pane = pane_ref()
+        if pane is None or self._generations.get(pane) != generation:
+            # Stale, the selection changed in the meantime
+            return False
+        self._set_idle(pane)
+        if result is not None:
+            self._results[pane] = result
+            refresh_from(pane)
+        return False
+
+
+def set_busy(pane, busy):
+    window = pane.get_window()
+    if window is None:
+        return
+    if busy:
+        window.set_cursor(
+            Gdk.Cursor.new_from_name(pane.get_display(), "progress"))
+    else:
+        window.set_cursor(None)
+
+
+INDEX = SongBitmapIndex()
+QUERY = ConjunctionQuery(INDEX)
+WORKER = SelectionWorker(INDEX, QUERY)
+
+
+def get_pane_states():
+    return plugin_config.get("pane_states").split(",")
+
+
+def set_pane_state(index, state):
+    states = get_pane_states()
+    states += [""] * (index + 1 - len(states))
+    states[index] = state
+    plugin_config.set("pane_states", ",".join(states).rstrip(","))
+
+
+def get_pane_state(pane):
+    """Returns the AND/OR state of a pane, the global one unless overridden"""
+    state = plugin_config.get("state")
+    try:
+        index = app.browser._panes.index(pane)
+    except (AttributeError, ValueError):
+        return state
+    states = get_pane_states()
+    if index < len(states) and states[index]:
+        return states[index]
+    return state
+
+
+def is_multi_selection(pane):
+    return pane.get_selection().count_selected_rows() > 1
+
+
+def refresh_from(pane):
+    """Re-evaluates the selection of a pane and refills the next ones"""
+    try:
+        if hasattr(pane, "_Pane__selection_changed"):
+            pane._Pane__selection_changed()
+    except Exception as e:
+        print_d(f"Conjunction Plugin: Error refreshing view: {e}")
+
+
+class MarkerRenderer(Gtk.CellRendererText):
+    """Renderer of the markers of PaneDecoration; a renderer can't be taken
+    out of a column, so it is hidden when the plugin is disabled and found
+    again when it's enabled"""
+
+
+class PaneDecoration:
+    """Per-pane additions: entries excluded with a middle click, and a
+    marker in the pane column showing them.
+
+    While a conjunction is selected, the marker shows for each entry how
+    many songs would remain if it was added, and entries leading to an
+    empty result are greyed out.
+    """
+
+    EXCLUDED_MARKER = "\u00ac"
+    COUNT_MARKUP = "<small>\u2227 %d</small>"
+
+    def __init__(self, pane):
+        self.excluded = set()
+        self.counts = None
+        self._column = pane.get_columns()[0]
+        self._renderer = None
+        self._cells = []
+        for cell in self._column.get_cells():
+            if isinstance(cell, MarkerRenderer):
+                self._renderer = cell
+            else:
+                self._cells.append(cell)
+        if self._renderer is None:
+            self._renderer = MarkerRenderer()
+            self._column.pack_end(self._renderer, False)
+        self._renderer.set_visible(True)
+        self._column.set_cell_data_func(self._renderer, self._cell_data)
+        self._sig_id = pane.connect("button-press-event", self._on_button_press)
+
+    def destroy(self, pane):
+        pane.disconnect(self._sig_id)
+        self._column.set_cell_data_func(self._renderer, None)
+        self._renderer.set_visible(False)
+        for cell in self._cells:
+            cell.set_sensitive(True)
+
+    def set_counts(self, pane, counts):
+        if counts is None and self.counts is None:
+            return
+        self.counts = counts
+        pane.queue_draw()
+
+    def is_excluded(self, entry):
+        return (not isinstance(entry, AllEntry)
+                and entry_key(entry) in self.excluded)
+
+    def _cell_data(self, column, cell, model, iter_, data):
+        entry = model.get_value(iter_, 0)
+        markup = ""
+        sensitive = True
+        if self.is_excluded(entry):
+            markup = self.EXCLUDED_MARKER
+        elif self.counts is not None and not isinstance(entry, AllEntry):
+            count = self.counts.get(entry_key(entry), 0)
+            markup = self.COUNT_MARKUP % count
+            sensitive = count > 0
+        cell.set_property("markup", markup)
+        # Data functions all run before the row is rendered
+        for other_cell in self._cells:
+            other_cell.set_sensitive(sensitive)
+
+    def _on_button_press(self, pane, event):
+        if event.button != 2 or event.type != Gdk.EventType.BUTTON_PRESS:
+            return False
+        path_info = pane.get_path_at_pos(int(event.x), int(event.y))
+        if not path_info:
+            return False
+        entry = pane.get_model()[path_info[0]][0]
+        if isinstance(entry, AllEntry):
+            return True
+
+        key = entry_key(entry)
+        if key in self.excluded:
+            self.excluded.discard(key)
+        else:
+            self.excluded.add(key)
+        pane.queue_draw()
+        refresh_from(pane)
+        return True
+
+
+DECORATIONS = weakref.WeakKeyDictionary()
+
+
+def decorate(pane):
+    decoration = DECORATIONS.get(pane)
+    if decoration is None:
+        decoration = DECORATIONS[pane] = PaneDecoration(pane)
+    return decoration
+
+
+def undecorate_all():
+    for pane, decoration in list(DECORATIONS.items()):
+        decoration.destroy(pane)
+    DECORATIONS.clear()
+
+
+def song_checksum(song):
+    return zlib.crc32(song.key.encode("utf-8", "surrogateescape"))
+
+
+def pane_title(pane, index):
+    return pane.get_columns()[0].get_title() or _("Pane %d") % (index + 1)
+
+
+class SavedView:
+    """A named selection of the panes: one plan per pane, bound to the pane
+    by its position and title. Its songs are kept as a set."""
+
+    def __init__(self, name, conditions):
+        self.name = name
+        # (pane index, pane title, plan)
+        self.conditions = conditions
+        self.songs = set()
+        self.stale = True
+        self._sorted = None
+
+    def is_bound(self, titles):
+        return all(index < len(titles) and titles[index] == title
+                   for index, title, _plan in self.conditions)
+
+    def matches(self, configs, song):
+        return all(plan.matches(song_keys(configs[index], song))
+                   for index, _title, plan in self.conditions)
+
+    def update(self, configs, songs):
+        for song in songs:
+            if self.matches(configs, song):
+                self.songs.add(song)
+            else:
+                self.songs.discard(song)
+        self._sorted = None
+
+    def remove(self, songs):
+        self.songs.difference_update(songs)
+        self._sorted = None
+
+    def set_songs(self, songs):
+        self.songs = set(songs)
+        self.stale = False
+        self._sorted = None
+
+    def sorted_songs(self):
+        if self._sorted is None:
+            self._sorted = sorted(
+                self.songs, key=operator.attrgetter("sort_key"))
+        return self._sorted
+
+    def to_dict(self):
+        def encode(keys):
+            return [None if k is UNKNOWN_KEY else k for k in keys]
+
+        return {
+            "name": self.name,
+            "panes": [{
+                "index": index,
+                "title": title,
+                "mode": "&" if plan.conjunction else "||",
+                "keys": encode(plan.keys),
+                "excluded": encode(plan.excluded),
+            } for index, title, plan in self.conditions],
+            "songs": None if self.stale else [s.key for s in self.songs],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Raises KeyError, TypeError or ValueError if data isn't a view"""
+        def decode(keys):
+            if not isinstance(keys, list) or not all(
+                    k is None or isinstance(k, str) for k in keys):
+                raise ValueError(f"invalid keys {keys!r}")
+            return frozenset(UNKNOWN_KEY if k is None else k for k in keys)
+
+        name = data["name"]
+        if not isinstance(name, str) or not isinstance(data["panes"], list):
+            raise ValueError(f"invalid view {name!r}")
+        conditions = []
+        for pane in data["panes"]:
+            index, title, mode = pane["index"], pane["title"], pane["mode"]
+            if (not isinstance(index, int) or index < 0
+                    or not isinstance(title, str) or mode not in ("&", "||")):
+                raise ValueError(f"invalid pane of view {name!r}")
+            conditions.append((index, title, SelectionPlan(
+                mode == "&", False, decode(pane["keys"]),
+                decode(pane["excluded"]))))
+        return cls(name, conditions)
+
+
+class SavedViews:
+    """Saved pane selections, materialized.
+
+    The songs of each view are kept up to date from the library signals,
+    by matching the changed songs against the plans of the view, so that
+    recalling a view doesn't evaluate anything. Views are evaluated in
+    full on the bitmap index only when saved, or when they can't be
+    trusted anymore (panes changed, library changed while not watched).
+
+    Views and their songs are written to a JSON snapshot, along with a
+    fingerprint of the library (its size and a checksum of the song keys,
+    both kept up to date from the signals) to check them against when
+    loaded.
+    """
+
+    FILENAME = "conjunction_views.json"
+    # Seconds between a library change and the snapshot being written
+    SAVE_DELAY = 10
+
+    def __init__(self, index, query):
+        self._index = index
+        self._query = query
+        self._views = OrderedDict()
+        self._library = None
+        self._sig_ids = []
+        self._save_id = None
+        self._fingerprint = [0, 0]
+
+    @property
+    def path(self):
+        return os.path.join(get_user_dir(), self.FILENAME)
+
+    def connect(self, library):
+        self.disconnect()
+        self._library = library
+        self._sig_ids = [
+            library.connect("added", self._on_added),
+            library.connect("changed", self._on_changed),
+            library.connect("removed", self._on_removed),
+        ]
+        checksum = 0
+        for song in library.values():
+            checksum ^= song_checksum(song)
+        self._fingerprint = [len(library), checksum]
+        self.load()
+
+    def disconnect(self):
+        if self._library is not None:
+            for sig_id in self._sig_ids:
+                self._library.disconnect(sig_id)
+            if self._save_id is not None:
+                GLib.source_remove(self._save_id)
+                self._save_id = None
+                self.save()
+        self._library = None
+        self._sig_ids = []
+        self._views.clear()
+
+    def names(self):
+        return list(self._views)
+
+    def add(self, name, panes):
+        """Saves the current selection of the panes as a view"""
+        conditions = []
+        for index, pane in enumerate(panes):
+            model, paths = pane.get_selection().get_selected_rows()
+            if not paths:
+                continue
+            plan = self._query.plan(
+                [model[path][0] for path in paths],
+                get_pane_state(pane) == "&", decorate(pane).excluded)
+            if plan.keys or plan.excluded:
+                conditions.append((index, pane_title(pane, index), plan))
+        view = SavedView(name, conditions)
+        self._views[name] = view
+        self._evaluate(view, panes)
+        self.save()
+
+    def remove(self, name):
+        if self._views.pop(name, None) is not None:
+            self.save()
+
+    def songs(self, name, panes):
+        """Returns the songs of a view, sorted, or None if it can't be
+        evaluated with these panes"""
+        view = self._views[name]
+        if view.stale and not self._evaluate(view, panes):
+            return None
+        return list(view.sorted_songs())
+
+    def _evaluate(self, view, panes):
+        titles = [pane_title(pane, index) for index, pane in enumerate(panes)]
+        if self._library is None or not view.is_bound(titles):
+            return False
+        bits = self._index.bits_of(self._library.values())
+        for index, _title, plan in view.conditions:
+            bits = plan.run(self._query, panes[index].get_model(), bits)
+        view.set_songs(self._index.songs_of(bits))
+        self._schedule_save()
+        return True
+
+    def _panes(self):
+        """Returns the pane titles and pattern configs, or None"""
+        panes = getattr(app.browser, "_panes", None)
+        if not panes:
+            return None
+        titles = [pane_title(pane, index) for index, pane in enumerate(panes)]
+        return titles, [pane.get_model().config for pane in panes]
+
+    def _on_added(self, library, songs):
+        self._update_fingerprint(songs, len(library))
+        self._on_changed(library, songs)
+
+    def _on_changed(self, library, songs):
+        panes = self._panes()
+        for view in self._views.values():
+            if view.stale:
+                continue
+            if panes is None or not view.is_bound(panes[0]):
+                # Can't be matched now, will be evaluated again when needed
+                view.stale = True
+            else:
+                view.update(panes[1], songs)
+        self._schedule_save()
+
+    def _on_removed(self, library, songs):
+        self._update_fingerprint(songs, len(library))
+        for view in self._views.values():
+            view.remove(songs)
+        self._schedule_save()
+
+    def _update_fingerprint(self, songs, size):
+        checksum = self._fingerprint[1]
+        for song in songs:
+            checksum ^= song_checksum(song)
+        self._fingerprint = [size, checksum]
+
+    def _schedule_save(self):
+        if self._save_id is None and self._views:
+            self._save_id = GLib.timeout_add_seconds(
+                self.SAVE_DELAY, self._save_timeout)
+
+    def _save_timeout(self):
+        self._save_id = None
+        self.save()
+        return False
+
+    def load(self):
+        self._views.clear()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print_d(f"Conjunction Plugin: Error loading views: {e}")
+            return
+
+        if not isinstance(data, dict) or not isinstance(
+                data.get("views", []), list):
+            print_d("Conjunction Plugin: Error loading views: not a snapshot")
+            return
+
+        consistent = data.get("library") == self._fingerprint
+        get = self._library.get
+        for view_data in data.get("views", []):
+            try:
+                view = SavedView.from_dict(view_data)
+                songs = view_data.get("songs")
+                if consistent and songs is not None:
+                    if not isinstance(songs, list):
+                        raise ValueError(f"invalid songs of {view.name!r}")
+                    songs = [get(key) for key in songs]
+                    view.set_songs(song for song in songs if song is not None)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                # Older or damaged snapshot, the other views are still fine
+                print_d(f"Conjunction Plugin: Skipping a saved view: {e!r}")
+                continue
+            self._views[view.name] = view
+        print_d(f"Conjunction Plugin: Loaded {len(self._views)} views, "
+                f"{'consistent' if consistent else 'to evaluate again'}")
+
+    def save(self):
+        if self._library is None:
+            return
+        if self._save_id is not None:
+            GLib.source_remove(self._save_id)
+            self._save_id = None
+        data = {
+            "library": self._fingerprint,
+            "views": [view.to_dict() for view in self._views.values()],
+        }
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print_d(f"Conjunction Plugin: Error saving views: {e}")
+
+
+VIEWS = SavedViews(INDEX, QUERY)
 
 
 def get_pixbuf_from_svg(svg_str, size=24):
@@ -90,7 +1337,10 @@ class ConjunctionButton(Gtk.ToggleButton):
         self.pixbuf_and = get_pixbuf_from_svg(ICON_AND)
         self.pixbuf_or = get_pixbuf_from_svg(ICON_OR)
 
-        self.set_tooltip_text(_("Toggle conjunction mode for multi-selections"))
+        self.set_tooltip_text(_(
+            "Toggle conjunction mode for multi-selections\n"
+            "Right-click to choose the mode of each pane, "
+            "middle-click an entry to exclude it"))
         self.set_always_show_image(True)
 
         self.set_active(initial_state_is_and)
@@ -115,51 +1365,117 @@ def conjunction_plugin_get_selected_songs(pane, sort=False):
     """Modified method of __get_selected_songs"""
     model, paths = pane.get_selection().get_selected_rows()
 
-    is_last_pane = False
-    try:
-        if hasattr(app.browser, "_panes") and app.browser._panes:
-            if pane is app.browser._panes[-1]:
-                is_last_pane = True
-    except Exception:
-        pass
+    decoration = decorate(pane)
+    is_and_mode = get_pane_state(pane) == "&"
 
-    is_and_mode = plugin_config.get("state") == "&"
+    # The last pane feeds the song list directly, its universe is the
+    # selection handed over by the previous pane so there's nothing to scan.
+    bits = 0
+    songs = []
+    counts = None
+    plan = None
+    if paths:
+        entries = [model[path][0] for path in paths]
+        plan = QUERY.plan(entries, is_and_mode, decoration.excluded)
 
-    # Apply conjunction (AND) only if enabled AND we are NOT in the last column.
-    if is_and_mode and not is_last_pane:
-        songs = model.get_songs_conjunction(paths)
+    if plan is None:
+        WORKER.cancel(pane)
+    elif not plan.keys and not plan.excluded:
+        # "All", the songs of the pane are kept up to date
+        WORKER.cancel(pane)
+        songs = INDEX.universe_songs(model, sort)
+        bits = None
+    elif is_plain_selection(plan):
+        # The songs of the entries are at hand, the index can't beat them
+        WORKER.cancel(pane)
+        songs = plain_songs(model, paths, entries, plan)
+        if has_counts(plan):
+            counts = QUERY.facet_counts(
+                model, plan, lambda: INDEX.ids_of_songs(songs))
+        if sort:
+            songs = sorted(songs, key=operator.attrgetter("sort_key"))
+        bits = None
     else:
-        songs = model.get_songs(paths)
+        universe = INDEX.universe(model)
+        result = WORKER.result(pane, model, plan, universe, sort)
+        if result is not None:
+            bits, songs, counts = result
+        elif QUERY.cost(model, plan, universe) > WORKER.THRESHOLD:
+            # The next panes stay empty until the worker calls us back
+            WORKER.submit(pane, model, plan, universe, sort)
+        else:
+            WORKER.cancel(pane)
+            bits = plan.run(QUERY, model, universe)
+            if sort:
+                songs = INDEX.sorted_songs_of(bits)
+            else:
+                songs = INDEX.songs_of(bits)
+            if has_counts(plan):
+                counts = QUERY.facet_counts(
+                    model, plan, lambda: INDEX.ids_of(bits))
 
-    if sort:
-        return sorted(songs, key=operator.attrgetter("sort_key"))
+    decoration.set_counts(pane, counts)
+    INDEX.hand_over(songs, bits)
     return songs
 
 
+def is_plain_selection(plan):
+    """Tells if a selection is the plain union of its entries, which the
+    pane model computes faster than the index: a disjunction, or a single
+    key, without exclusions"""
+    return not plan.excluded and (not plan.conjunction or len(plan.keys) <= 1)
+
+
+def plain_songs(model, paths, entries, plan):
+    """Returns the songs of a plain selection, see is_plain_selection"""
+    if plan.conjunction:
+        # A single key, "All" doesn't constrain a conjunction
+        for entry in entries:
+            if not isinstance(entry, AllEntry):
+                return set(entry.songs)
+    return model.get_songs(paths)
+
+
 def conjunction_plugin_get_songs(model, paths):
-    """Get all songs for the given paths with conjunction"""
-    s = set()
+    """Get all songs for the given paths, combined like the selection of
+    the pane showing the model: with its AND/OR state and exclusions"""
     if not paths:
-        return s
+        return set()
+
+    pane = pane_of(model)
+    decoration = DECORATIONS.get(pane) if pane is not None else None
+    excluded = decoration.excluded if decoration is not None else ()
+    entries = [model[path][0] for path in paths]
+    plan = QUERY.plan(entries, get_pane_state(pane) == "&", excluded)
+    if not plan.keys and not plan.excluded:
+        return set(INDEX.universe_songs(model))
+    if is_plain_selection(plan):
+        return set(plain_songs(model, paths, entries, plan))
+    return set(INDEX.songs_of(plan.run(QUERY, model, INDEX.universe(model))))
+
 
-    constraining_entries = []
-    for path in paths:
-        entry = model[path][0]
-        if not isinstance(entry, AllEntry):
-            constraining_entries.append(entry)
+def pane_of(model):
+    """Returns the pane of the browser showing a model, if any"""
+    for pane in getattr(app.browser, "_panes", ()):
+        if pane.get_model() is model:
+            return pane
+    return None
 
-    if not constraining_entries:
-        for entry in model.itervalues():
-            s.update(entry.songs)
-        return s
 
-    s = set(constraining_entries[0].songs)
-    for entry in constraining_entries[1:]:
-        if not s:
-            return set()
-        s.intersection_update(entry.songs)
+def filling_universe(method):
+    """Wraps PaneModel.add_songs"""
+    def wrapper(model, songs, *args, **kwargs):
+        songs = INDEX.filling(model, songs)
+        return method(model, songs, *args, **kwargs)
+    return wrapper
 
-    return s
+
+def removing_universe(method):
+    """Wraps PaneModel.remove_songs"""
+    def wrapper(model, songs, *args, **kwargs):
+        songs = INDEX.removing(model, songs)
+        return method(model, songs, *args, **kwargs)
+    return wrapper
 
 
 class Conjunction(EventPlugin):
@@ -172,7 +1488,7 @@ class Conjunction(EventPlugin):
     )
 
     PLUGIN_ICON = Icons.SYSTEM_SEARCH
-    PLUGIN_VERSION = "0.7"
+    PLUGIN_VERSION = "0.11"
 
     def enabled(self):
         # Monkey-patching
@@ -180,12 +1496,21 @@ class Conjunction(EventPlugin):
         Pane._Pane__get_selected_songs = conjunction_plugin_get_selected_songs
         PaneModel.get_songs_conjunction = conjunction_plugin_get_songs
 
+        self.keep_original_add_songs_method = PaneModel.add_songs
+        self.keep_original_remove_songs_method = PaneModel.remove_songs
+        PaneModel.add_songs = filling_universe(PaneModel.add_songs)
+        PaneModel.remove_songs = removing_universe(PaneModel.remove_songs)
+
+        INDEX.connect(app.library)
+        VIEWS.connect(app.library)
+
         # UI Initialization
         current_state = plugin_config.get("state")
         self.button = ConjunctionButton(initial_state_is_and=(current_state == "&"))
 
         # Connect to main plugin logic
         self.button.connect("toggled", self._on_button_toggled)
+        self.button.connect("button-press-event", self._on_button_press)
 
         # Inject into Search Bar
         if hasattr(app.browser, "_sb_box"):
@@ -199,22 +1524,115 @@ class Conjunction(EventPlugin):
             self.button.destroy()
             self.button = None
 
+        undecorate_all()
+
         Pane._Pane__get_selected_songs = self.keep_original_get_songs_method
         if hasattr(PaneModel, "get_songs_conjunction"):
             del PaneModel.get_songs_conjunction
 
+        PaneModel.add_songs = self.keep_original_add_songs_method
+        PaneModel.remove_songs = self.keep_original_remove_songs_method
+
+        WORKER.clear()
+        VIEWS.disconnect()
+        INDEX.disconnect()
+        QUERY.clear()
+
     def _on_button_toggled(self, button):
         """Handle the state change and refresh the browser view"""
         new_state = "&" if button.get_active() else "||"
         plugin_config.set("state", new_state)
 
-        try:
-            if hasattr(app.browser, "_panes") and app.browser._panes:
-                first_pane = app.browser._panes[0]
-                if hasattr(first_pane, "_Pane__selection_changed"):
-                    first_pane._Pane__selection_changed()
-        except Exception as e:
-            print_d(f"Conjunction Plugin: Error refreshing view: {e}")
+        # Only a multi-selection depends on the mode: refilling from the first
+        # such pane refreshes the ones after it and keeps the others as is.
+        states = get_pane_states()
+        panes = getattr(app.browser, "_panes", None) or []
+        for index, pane in enumerate(panes):
+            overridden = index < len(states) and states[index]
+            if not overridden and is_multi_selection(pane):
+                refresh_from(pane)
+                break
+
+    def _on_button_press(self, button, event):
+        if event.button != 3:
+            return False
+        menu = self._build_pane_menu()
+        menu.attach_to_widget(button, None)
+        menu.popup_at_pointer(event)
+        return True
+
+    def _build_pane_menu(self):
+        """Menu overriding the AND/OR state of each pane, and managing the
+        saved views"""
+        menu = Gtk.Menu()
+        choices = [("", _("Default")), ("&", _("AND")), ("||", _("OR"))]
+        states = get_pane_states()
+        panes = getattr(app.browser, "_panes", None) or []
+
+        for index, pane in enumerate(panes):
+            current = states[index] if index < len(states) else ""
+            item = Gtk.MenuItem(label=pane_title(pane, index))
+            submenu = Gtk.Menu()
+            group = None
+            for state, label in choices:
+                radio = Gtk.RadioMenuItem.new_with_label_from_widget(group, label)
+                group = radio
+                radio.set_active(state == current)
+                radio.connect("toggled", self._on_pane_state_toggled, index, state)
+                submenu.append(radio)
+            item.set_submenu(submenu)
+            menu.append(item)
+
+        if panes:
+            menu.append(Gtk.SeparatorMenuItem())
+            names = VIEWS.names()
+            for name in names:
+                item = Gtk.MenuItem(label=name)
+                item.connect("activate", self._on_view_activate, name)
+                menu.append(item)
+
+            save_item = Gtk.MenuItem(label=_("Save Selection as View…"))
+            save_item.connect("activate", self._on_view_save)
+            menu.append(save_item)
+
+            if names:
+                delete_item = Gtk.MenuItem(label=_("Delete View"))
+                submenu = Gtk.Menu()
+                for name in names:
+                    item = Gtk.MenuItem(label=name)
+                    item.connect("activate", self._on_view_delete, name)
+                    submenu.append(item)
+                delete_item.set_submenu(submenu)
+                menu.append(delete_item)
+
+        menu.show_all()
+        return menu
+
+    def _on_view_activate(self, item, name):
+        songs = VIEWS.songs(name, app.browser._panes)
+        if songs is None:
+            print_d(f"Conjunction Plugin: View {name} doesn't match the panes")
+            return
+        app.browser.songs_selected(songs, True)
+
+    def _on_view_save(self, item):
+        name = GetStringDialog(
+            get_top_parent(self.button), _("Save Selection as View"),
+            _("Enter a name for the view:"), button_label=_("_Save"),
+            button_icon=Icons.DOCUMENT_SAVE).run()
+        if name:
+            VIEWS.add(name, app.browser._panes)
+
+    def _on_view_delete(self, item, name):
+        VIEWS.remove(name)
+
+    def _on_pane_state_toggled(self, item, index, state):
+        if not item.get_active():
+            return
+        set_pane_state(index, state)
+        pane = app.browser._panes[index]
+        if is_multi_selection(pane):
+            refresh_from(pane)
 
     @classmethod
     def PluginPreferences(cls, parent):
@@ -253,4 +1671,16 @@ class Conjunction(EventPlugin):
 
         vbox.pack_start(hboxAND, False, False, 0)
 
+        labelContentNOT = _(
+            "<b>NOT / Exclusion</b>\n"
+            "Middle-click an entry to exclude its songs, whatever the mode. "
+            "Right-click the switch to choose the mode of each pane, or to "
+            "save the selection as a view and recall it later."
+        )
+        labelNOT = Gtk.Label(xalign=0)
+        labelNOT.set_markup(labelContentNOT)
+        labelNOT.set_line_wrap(True)
+
+        vbox.pack_start(labelNOT, False, False, 0)
+
         return vbox
@@ -13,7 +13,10 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from functools import lru_cache
+from itertools import groupby
 from math import ceil, floor
 
 from gi.repository import Gtk, Gdk, Gst
@@ -66,11 +69,133 @@ class Config:
     compression_factor = FloatConfProp(_config, "compression_factor", 3.0)
     scroll_controls_compression = BoolConfProp(_config, "scroll_controls_compression", True)
     height_px = IntConfProp(_config, "height_px", 40)
+    skip_leading_silence = BoolConfProp(_config, "skip_leading_silence", False)
+    skip_trailing_silence = BoolConfProp(_config, "skip_trailing_silence", False)
+    scroll_jumps_sections = BoolConfProp(_config, "scroll_jumps_sections", False)
+    silence_threshold_db = FloatConfProp(_config, "silence_threshold_db", -50.0)
+    loud_threshold_db = FloatConfProp(_config, "loud_threshold_db", -12.0)
+    min_silence_duration = FloatConfProp(_config, "min_silence_duration", 2.0)
 
 
 CONFIG = Config()
 
 
+class SectionIndex:
+    """Silent and loud regions of a waveform.
+
+    Regions are stored as sorted (start, end) fractions of the song length,
+    so that seeking only needs a bisection instead of a scan of the RMS data.
+    """
+
+    def __init__(self, silent=(), loud=()):
+        self.silent = list(silent)
+        self.loud = list(loud)
+        self._loud_starts = [start for start, _end in self.loud]
+
+    @classmethod
+    def from_rms(cls, rms_vals, length, silence_db, loud_db, min_silence):
+        """Builds the index from normalized RMS values.
+
+        `silence_db` is an absolute level, `loud_db` is relative to the peak
+        of the song and `min_silence` is a duration in seconds.
+        """
+        count = len(rms_vals)
+        if not count or length <= 0:
+            return cls()
+
+        silence_level = pow(10, silence_db / 20)
+        loud_level = max(rms_vals) * pow(10, loud_db / 20)
+        min_points = max(1, int(min_silence * count / length))
+
+        def runs(flags):
+            # Run-length encode the thresholded values in a single pass
+            start = 0
+            for flag, group in groupby(flags):
+                end = start + sum(1 for _ in group)
+                if flag:
+                    yield start, end
+                start = end
+
+        silent = [
+            (start / count, end / count)
+            for start, end in runs(v < silence_level for v in rms_vals)
+            if end - start >= min_points or start == 0 or end == count
+        ]
+        # Short dips between loud runs belong to the same section
+        loud = []
+        for start, end in runs(v >= loud_level for v in rms_vals):
+            if loud and start - loud[-1][1] < min_points:
+                loud[-1][1] = end
+            else:
+                loud.append([start, end])
+        loud = [(start / count, end / count) for start, end in loud]
+        return cls(silent, loud)
+
+    def leading_silence_end(self):
+        """Returns where the content starts, 0 if there's no leading silence"""
+        # A completely silent song has no content to skip to
+        if self.silent and self.silent[0][0] == 0 and self.silent[0][1] < 1.0:
+            return self.silent[0][1]
+        return 0.0
+
+    def trailing_silence_start(self):
+        """Returns where the trailing silence starts, None if there's none"""
+        if self.silent and self.silent[-1][1] == 1.0 and self.silent[-1][0] > 0:
+            return self.silent[-1][0]
+        return None
+
+    def next_loud(self, position):
+        """Returns the start of the first loud section after `position`"""
+        index = bisect_right(self._loud_starts, position)
+        if index < len(self._loud_starts):
+            return self._loud_starts[index]
+        return None
+
+    def previous_loud(self, position, margin=0.0):
+        """Returns the start of the last loud section before `position`.
+
+        `margin` lets a jump skip over the section currently being played
+        when the position is just after its start.
+        """
+        index = bisect_left(self._loud_starts, position - margin)
+        if index > 0:
+            return self._loud_starts[index - 1]
+        return None
+
+
+class WaveformCache:
+    """RMS values of the last songs played, so that playing one of them
+    again has its waveform and its sections at once, without decoding it.
+    Keyed by file and modification time, a rewritten file is decoded again.
+    """
+
+    MAX_SONGS = 20
+
+    def __init__(self):
+        self._waveforms = OrderedDict()
+
+    @staticmethod
+    def _key(song, points):
+        return (song("~filename"), song("~#mtime"), points)
+
+    def get(self, song, points):
+        """Returns a copy of the RMS values of a song, None if unknown"""
+        key = self._key(song, points)
+        rms_vals = self._waveforms.get(key)
+        if rms_vals is None:
+            return None
+        self._waveforms.move_to_end(key)
+        return list(rms_vals)
+
+    def put(self, song, points, rms_vals):
+        self._waveforms[self._key(song, points)] = tuple(rms_vals)
+        if len(self._waveforms) > self.MAX_SONGS:
+            self._waveforms.popitem(last=False)
+
+
+WAVEFORMS = WaveformCache()
+
+
 class WaveformSeekBar(Gtk.Box):
     """A widget containing labels and the seekbar."""
 
@@ -79,6 +204,11 @@ class WaveformSeekBar(Gtk.Box):
 
         self._player = player
         self._rms_vals = []
+        self._sections = SectionIndex()
+        # Where the content of the current song starts, in seconds, once
+        # known from the first levels or from the whole waveform
+        self._leading_silence = None
+        self._skipped_song = None
         self._hovering = False
 
         self._elapsed_label = TimeLabel()
@@ -131,6 +261,11 @@ class WaveformSeekBar(Gtk.Box):
         if not song.is_file:
             return
 
+        rms_vals = WAVEFORMS.get(song, points)
+        if rms_vals is not None:
+            self._set_waveform(rms_vals)
+            return
+
         command_template = """
         uridecodebin name=uridec
         ! audioconvert
@@ -153,6 +288,9 @@ class WaveformSeekBar(Gtk.Box):
 
         self._pipeline = pipeline
         self._new_rms_vals = []
+        self._song = song
+        self._interval = interval
+        self._silence_level = pow(10, CONFIG.silence_threshold_db / 20)
 
     def _on_bus_message(self, bus, message, points):
         force_stop = False
@@ -170,6 +308,13 @@ class WaveformSeekBar(Gtk.Box):
                     # Normalize dB value to value between 0 and 1
                     rms = pow(10, (rms_db_avg / 20))
                     self._new_rms_vals.append(rms)
+                    if (self._leading_silence is None
+                            and rms >= self._silence_level):
+                        # The content starts here, no need to wait for the
+                        # whole song to skip the silence before it
+                        self._leading_silence = (
+                            (len(self._new_rms_vals) - 1) * self._interval / 1e9)
+                        self._skip_leading_silence()
                     if len(self._new_rms_vals) >= points:
                         # The audio might be much longer than we anticipated
                         # and we would get way too many events due to the too
@@ -182,12 +327,69 @@ class WaveformSeekBar(Gtk.Box):
             self._clean_pipeline()
 
             # Update the waveform with the new data
-            self._rms_vals = self._new_rms_vals
-            self._waveform_scale.reset(self._rms_vals)
-            self._update_redraw_interval()
+            WAVEFORMS.put(self._song, points, self._new_rms_vals)
+            self._set_waveform(self._new_rms_vals)
 
             # Clear temporary reference to the waveform data
             del self._new_rms_vals
+            self._song = None
+
+    def _set_waveform(self, rms_vals):
+        self._rms_vals = rms_vals
+        self._sections = self._compute_sections(rms_vals)
+        self._waveform_scale.reset(self._rms_vals, self._sections)
+        self._update_redraw_interval()
+        if self._leading_silence is None and self._player.info:
+            self._leading_silence = (self._sections.leading_silence_end()
+                                     * self._player.info("~#length"))
+        self._skip_leading_silence()
+
+    def update_sections(self):
+        """Recomputes the sections of the current song, after a change of
+        their settings"""
+        self._sections = self._compute_sections(self._rms_vals)
+        self._waveform_scale.set_sections(self._sections)
+
+    def _compute_sections(self, rms_vals):
+        if not self._player.info:
+            return SectionIndex()
+        return SectionIndex.from_rms(
+            rms_vals,
+            self._player.info("~#length"),
+            CONFIG.silence_threshold_db,
+            CONFIG.loud_threshold_db,
+            CONFIG.min_silence_duration,
+        )
+
+    def _skip_leading_silence(self):
+        player = self._player
+        # Only once per song, the waveform is also recomputed on tag changes
+        if (
+            not CONFIG.skip_leading_silence
+            or not player.info
+            or not player.seekable
+            or self._leading_silence is None
+            or self._skipped_song is player.info
+        ):
+            return
+        self._skipped_song = player.info
+
+        start = self._leading_silence
+        if start and player.get_position() < start * 1000:
+            print_d(f"Skipping {start:.1f}s of leading silence")
+            player.seek(start * 1000)
+
+    def _skip_trailing_silence(self, player):
+        if not CONFIG.skip_trailing_silence or not player.info:
+            return
+        end = self._sections.trailing_silence_start()
+        if end is None:
+            return
+        length = player.info("~#length")
+        if player.get_position() >= end * length * 1000:
+            print_d("Skipping trailing silence")
+            self._sections = SectionIndex()
+            player.next()
 
     def _clean_pipeline(self):
         if hasattr(self, "_pipeline") and self._pipeline:
@@ -216,9 +418,12 @@ class WaveformSeekBar(Gtk.Box):
 
     def _on_tick_waveform(self, tracker, player):
         self._update_waveform(player)
+        self._skip_trailing_silence(player)
 
     def _on_seekable_changed(self, player, *args):
         self._update_label(player)
+        # The content start may be known before the song can be seeked
+        self._skip_leading_silence()
 
     def _on_player_seek(self, player, song, ms):
         self._update(player)
@@ -235,12 +440,18 @@ class WaveformSeekBar(Gtk.Box):
             self._update_label(player)
 
     def _on_song_started(self, player, song):
+        self._rms_vals.clear()
+        self._sections = SectionIndex()
+        self._leading_silence = None
+        self._skipped_song = None
+        self._waveform_scale.set_sections(self._sections)
+
         if player.info:
-            # Trigger a re-computation of the waveform
+            # Trigger a re-computation of the waveform, known at once if the
+            # song was played recently
             self._create_waveform(player.info, CONFIG.max_data_points)
             self._resize_labels(player.info)
 
-        self._rms_vals.clear()
         self._update(player, True)
 
     def _on_song_ended(self, player, song, ended):
@@ -345,6 +556,7 @@ class WaveformScale(Gtk.EventBox):
     """The waveform widget."""
 
     _rms_vals: list[int] = []
+    _sections = SectionIndex()
     _player = None
 
     def __init__(self, player):
@@ -364,11 +576,15 @@ class WaveformScale(Gtk.EventBox):
     def width(self):
         return self.get_allocation().width
 
-    def reset(self, rms_vals):
+    def reset(self, rms_vals, sections=None):
         self._rms_vals = rms_vals
+        self._sections = sections or SectionIndex()
         self._seeking = False
         self.queue_draw()
 
+    def set_sections(self, sections):
+        self._sections = sections
+
     @classmethod
     def reset_config(cls):
         cls.hover_color.cache_clear()
@@ -647,6 +863,27 @@ class WaveformScale(Gtk.EventBox):
             return True
         return None
 
+    def _seek_by_scroll(self, forward):
+        """Seeks to the next/previous loud section if enabled and known,
+        falls back to the configured seek amount."""
+        player = self._player
+        if CONFIG.scroll_jumps_sections and player.info:
+            length = player.info("~#length")
+            if length:
+                position = player.get_position() / 1000.0 / length
+                if forward:
+                    target = self._sections.next_loud(position)
+                else:
+                    # Don't get stuck at the start of the current section
+                    target = self._sections.previous_loud(position, 1.0 / length)
+                if target is not None:
+                    player.seek(target * length * 1000)
+                    return
+        if forward:
+            player.seek(player.get_position() + CONFIG.seek_amount)
+        else:
+            player.seek(player.get_position() - CONFIG.seek_amount)
+
     def do_scroll_event(self, event):
         if CONFIG.scroll_controls_compression:
             if event.direction == Gdk.ScrollDirection.UP:
@@ -660,20 +897,20 @@ class WaveformScale(Gtk.EventBox):
                 self.queue_draw()
                 return True
             elif event.direction == Gdk.ScrollDirection.RIGHT:
-                self._player.seek(self._player.get_position() + CONFIG.seek_amount)
+                self._seek_by_scroll(True)
                 self.queue_draw()
                 return True
             elif event.direction == Gdk.ScrollDirection.LEFT:
-                self._player.seek(self._player.get_position() - CONFIG.seek_amount)
+                self._seek_by_scroll(False)
                 self.queue_draw()
                 return True
         else:
             if event.direction == Gdk.ScrollDirection.UP:
-                self._player.seek(self._player.get_position() + CONFIG.seek_amount)
+                self._seek_by_scroll(True)
                 self.queue_draw()
                 return True
             elif event.direction == Gdk.ScrollDirection.DOWN:
-                self._player.seek(self._player.get_position() - CONFIG.seek_amount)
+                self._seek_by_scroll(False)
                 self.queue_draw()
                 return True
 
@@ -756,6 +993,34 @@ class WaveformSeekBarPlugin2(EventPlugin):
         def on_scroll_controls_compression_toggled(button, *args):
             CONFIG.scroll_controls_compression = button.get_active()
 
+        def create_switch(label_text, config_item):
+            def on_toggled(button, *args):
+                setattr(CONFIG, config_item, button.get_active())
+
+            sw = Gtk.Switch()
+            label = Gtk.Label(label_text)
+            sw.set_active(getattr(CONFIG, config_item))
+            sw.connect("notify::active", on_toggled)
+            hbox = Gtk.HBox(spacing=6)
+            hbox.pack_start(label, False, True, 0)
+            hbox.pack_end(sw, False, True, 0)
+            return hbox
+
+        def on_silence_threshold_changed(spinbox):
+            CONFIG.silence_threshold_db = spinbox.get_value()
+            if self._bar is not None:
+                self._bar.update_sections()
+
+        def on_min_silence_duration_changed(spinbox):
+            CONFIG.min_silence_duration = spinbox.get_value()
+            if self._bar is not None:
+                self._bar.update_sections()
+
+        def on_loud_threshold_changed(spinbox):
+            CONFIG.loud_threshold_db = spinbox.get_value()
+            if self._bar is not None:
+                self._bar.update_sections()
+
         def create_color(label_text, config_item):
             hbox = Gtk.HBox(spacing=6)
             label = Gtk.Label(label=label_text)
@@ -887,6 +1152,56 @@ class WaveformSeekBarPlugin2(EventPlugin):
         hbox.pack_end(height_px, False, True, 0)
         vbox.pack_start(hbox, True, True, 0)
 
+        box = create_switch(
+            _("Scroll seeking jumps to the next/previous loud section"),
+            "scroll_jumps_sections")
+        vbox.pack_start(box, True, True, 0)
+
+        box = create_switch(
+            _("Skip leading silence"), "skip_leading_silence")
+        vbox.pack_start(box, True, True, 0)
+
+        box = create_switch(
+            _("Skip trailing silence"), "skip_trailing_silence")
+        vbox.pack_start(box, True, True, 0)
+
+        hbox = Gtk.HBox(spacing=6)
+        label = Gtk.Label(label=_("Silence threshold (dB):"))
+        hbox.pack_start(label, False, True, 0)
+        silence_threshold = Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                CONFIG.silence_threshold_db, -90.0, -10.0, 1.0, 5.0, 0)
+        )
+        silence_threshold.set_numeric(True)
+        silence_threshold.connect("changed", on_silence_threshold_changed)
+        hbox.pack_end(silence_threshold, False, True, 0)
+        vbox.pack_start(hbox, True, True, 0)
+
+        hbox = Gtk.HBox(spacing=6)
+        label = Gtk.Label(label=_("Minimum silence duration (seconds):"))
+        hbox.pack_start(label, False, True, 0)
+        min_silence = Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                CONFIG.min_silence_duration, 0.5, 30.0, 0.5, 1.0, 0)
+        )
+        min_silence.set_digits(1)
+        min_silence.set_numeric(True)
+        min_silence.connect("changed", on_min_silence_duration_changed)
+        hbox.pack_end(min_silence, False, True, 0)
+        vbox.pack_start(hbox, True, True, 0)
+
+        hbox = Gtk.HBox(spacing=6)
+        label = Gtk.Label(label=_("Loud section threshold (dB below peak):"))
+        hbox.pack_start(label, False, True, 0)
+        loud_threshold = Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                CONFIG.loud_threshold_db, -40.0, 0.0, 1.0, 5.0, 0)
+        )
+        loud_threshold.set_numeric(True)
+        loud_threshold.connect("changed", on_loud_threshold_changed)
+        hbox.pack_end(loud_threshold, False, True, 0)
+        vbox.pack_start(hbox, True, True, 0)
+
         return vbox
 
 